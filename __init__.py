@@ -2,6 +2,14 @@ from dragonfly import RecognitionObserver
 
 from log import logger
 
+# Natlink loads this module first. Log the startup time of every script module imported from here on and append it to
+# startup_profile.jsonl.
+PROFILE_STARTUP = False
+startup_profiler = None
+if PROFILE_STARTUP:
+    from lib.startup_profiler import StartupProfiler
+    startup_profiler = StartupProfiler().install()
+
 
 class RecognitionLogger(RecognitionObserver):
     def on_post_recognition(self, words, rule, node, results):
@@ -13,6 +21,12 @@ recog_logger.register()
 
 
 def unload():
+    global startup_profiler
+    if startup_profiler is not None:
+        logger.info('\n'.join(startup_profiler.report()))
+        startup_profiler.uninstall()
+    startup_profiler = None
+
     global recog_logger
     if recog_logger:
         recog_logger.unregister()
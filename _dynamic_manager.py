@@ -1,93 +1,22 @@
 import importlib
 import traceback
 
-from dragonfly import Context, RecognitionObserver, AppContext, MappingRule, Function, Choice, Grammar, Window
+from dragonfly import AppContext, MappingRule, Function, Choice, Grammar
 
+from lib.dynamic import DynamicContext, DynamicGrammarStateManager, ForegroundWatcher, memoize_context
+from lib.grammar_cache import GrammarCache
+from lib.spec_parsing import spec_parse_cache
 from log import logger
 
+# Parse each distinct spec of the rules of the modules imported from here on once.
+spec_parse_cache.install()
 
-class DynamicContext(Context):
-    def __init__(self, fallback, focus_context):
-        super(DynamicContext, self).__init__()
-        self.fallback = fallback
-        self.focus_context = focus_context
-
-    def matches(self, executable, title, handle):
-        if not self.is_dynamic_active(executable, title, handle):
-            return self.fallback.matches(executable, title, handle) if self.fallback is not None else True
-        return True
-
-    def is_dynamic_active(self, executable, title, handle):
-        if self.focus_context is None:
-            return True
-        return self.focus_context.matches(executable, title, handle)
-
-
-class DynamicGrammarStateManager(RecognitionObserver):
-
-    def __init__(self, grammars_grouped_by_module, modules_by_name, dynamic_context):
-        super(DynamicGrammarStateManager, self).__init__()
-        self.is_dynamic_active = False
-        self.context = dynamic_context
-        self.grammars_grouped_by_module = grammars_grouped_by_module
-        self.modules_by_name = modules_by_name
-        self.static_grammar_states = self.get_current_grammar_states()
-        self.states_to_restore_on_window_focus = {name: [False for _ in grammars]
-                                                  for name, grammars in grammars_grouped_by_module.items()}
-        self.states_to_restore_on_manual_enable = self.get_current_grammar_states()
-        self.module_is_enabled = {name: False for name in grammars_grouped_by_module}
-
-    def dynamic_enable(self, module_name):
-        logger.info("dynamic enable" + module_name)
-        if self.module_is_enabled[module_name]:
-            return
-        self.module_is_enabled[module_name] = True
-        logger.info(self.states_to_restore_on_manual_enable[module_name])
-        self.apply_states_to_grammars(self.grammars_grouped_by_module[module_name],
-                                      self.states_to_restore_on_manual_enable[module_name])
-        for name in self.grammars_grouped_by_module:
-            if name == module_name:
-                continue
-            self.dynamic_disable(name)
-
-    def dynamic_disable(self, module_name):
-        logger.info("dynamic disable" + module_name)
-        if not self.module_is_enabled[module_name]:
-            return
-        self.module_is_enabled[module_name] = False
-        self.states_to_restore_on_manual_enable[module_name] = [grammar.enabled for grammar in
-                                                                self.grammars_grouped_by_module[module_name]]
-        self.apply_states_to_grammars(self.grammars_grouped_by_module[module_name],
-                                      [False for _ in self.grammars_grouped_by_module[module_name]])
-
-    def get_current_grammar_states(self):
-        return {name: [grammar.enabled for grammar in grammars]
-                for name, grammars in self.grammars_grouped_by_module.items()}
-
-    def on_begin(self):
-        window = Window.get_foreground()
-        if self.is_dynamic_active and not self.context.is_dynamic_active(window.executable, window.title,
-                                                                         window.handle):
-            self.is_dynamic_active = False
-            self.states_to_restore_on_window_focus = self.get_current_grammar_states()
-            self.set_current_grammar_states(self.static_grammar_states)
-        elif not self.is_dynamic_active and self.context.is_dynamic_active(window.executable, window.title,
-                                                                           window.handle):
-            self.is_dynamic_active = True
-            self.static_grammar_states = self.get_current_grammar_states()
-            self.set_current_grammar_states(self.states_to_restore_on_window_focus)
-
-    @staticmethod
-    def apply_states_to_grammars(grammars, states):
-        for grammar, enabled in zip(grammars, states):
-            grammar.disable()
-            if enabled:
-                grammar.enable()
-
-    def set_current_grammar_states(self, grammar_states):
-        for name, grammars in self.grammars_grouped_by_module.items():
-            self.apply_states_to_grammars(grammars, grammar_states[name])
-
+# Reuse the compiled binaries of grammars whose sources did not change since they were last loaded.
+# Off by default, see the README.
+USE_GRAMMAR_CACHE = False
+grammar_cache = GrammarCache()
+if USE_GRAMMAR_CACHE:
+    grammar_cache.install()
 
 dynamic_module_names = ['chrome', 'pycharm', 'visual_studio']
 dynamic_modules = {}
@@ -108,17 +37,38 @@ dynamic_modules = {name: importlib.import_module(name) for name in dynamic_modul
 dynamic_module_grammars = {name: dynamic_modules[name].EXPORT_GRAMMARS for name in dynamic_module_names}  # type: ignore
 citrix_context = AppContext(executable='notepad')
 nomachine_context = AppContext(executable='nxplayer')
-citrix_or_nomachine_context = citrix_context | nomachine_context
+citrix_or_nomachine_context = memoize_context(citrix_context | nomachine_context)
+
 
-for mod_name, export_grammars in dynamic_module_grammars.items():
-    for gram in export_grammars:
+def make_contexts_dynamic(grammars):
+    for gram in grammars:
         if not isinstance(gram._context, DynamicContext):
             gram._context = DynamicContext(fallback=gram._context, focus_context=citrix_or_nomachine_context)
 
+
+for export_grammars in dynamic_module_grammars.values():
+    make_contexts_dynamic(export_grammars)
+
+# Modules with DEFERRED_GRAMMARS build and load them when the foreground window or an enable command first needs them,
+# on the engine thread only, see DeferredGrammars. The foreground watcher below does this, not the start of an
+# utterance.
+deferred_grammars = {name: module.DEFERRED_GRAMMARS for name, module in dynamic_modules.items()
+                     if hasattr(module, 'DEFERRED_GRAMMARS')}
+for deferred in deferred_grammars.values():
+    deferred.on_load.append(make_contexts_dynamic)
+
 manager = DynamicGrammarStateManager(dynamic_module_grammars, dynamic_modules,
-                                     DynamicContext(fallback=None, focus_context=citrix_or_nomachine_context))
+                                     DynamicContext(fallback=None, focus_context=citrix_or_nomachine_context),
+                                     deferred_grammars=deferred_grammars)
 manager.register()
 
+# Set to poll the foreground window in the background so grammar states are switched before the user starts speaking.
+# Otherwise the foreground window is still polled to load deferred grammars while there are any.
+WATCH_FOREGROUND = False
+foreground_watcher = ForegroundWatcher(manager.update if WATCH_FOREGROUND else manager.update_deferred_grammars)
+if WATCH_FOREGROUND or deferred_grammars:
+    foreground_watcher.start()
+
 spoken_modules = {"chrome": "chrome", "pycharm": "pycharm", "visual studio": "visual_studio"}
 
 
@@ -137,6 +87,12 @@ dynamic_grammar.load()
 
 # Unload function which will be called at unload time.
 def unload():
+    foreground_watcher.stop()
+    logger.info('grammar cache hits: %d, misses: %d', grammar_cache.hits, grammar_cache.misses)
+    grammar_cache.uninstall()
+    logger.info('spec parse cache hits: %d, misses: %d', spec_parse_cache.hits, spec_parse_cache.misses)
+    spec_parse_cache.uninstall()
+
     global dynamic_grammar
     if dynamic_grammar: dynamic_grammar.unload()
     dynamic_grammar = None
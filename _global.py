@@ -1,6 +1,6 @@
-from dragonfly import MappingRule, Function, Key, Mouse, Pause, Repeat, Dictation, IntegerRef, Grammar
+from dragonfly import MappingRule, Function, Key, Mouse, Pause, Repeat, Dictation, Grammar
 
-from lib.common import SpellLetterSequenceRule
+from lib.common import NumberRef, SpellLetterSequenceRule
 from lib.format import FormatRule
 from lib.sound import play, SND_DING, SND_DEACTIVATE
 
@@ -37,7 +37,7 @@ class GlobalRule(MappingRule):
         'reload natlink': Function(reload_natlink),
     }
     extras = [
-        IntegerRef('n', 1, 101, default=1),
+        NumberRef('n', 1, 101, default=1),
         Dictation('text'),
     ]
 
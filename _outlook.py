@@ -1,6 +1,8 @@
-from dragonfly import MappingRule, Key, Dictation, Grammar, Text, ShortIntegerRef, AppContext
+from dragonfly import MappingRule, Dictation, Grammar, AppContext
 
-from lib.common import LetterSequenceRef, release
+from lib.actions import Key, Text
+from lib.common import LetterSequenceRef, NumberRef, release
+from lib.rules import precompile_static_actions
 
 rules = MappingRule(
     name="outlook",
@@ -63,12 +65,13 @@ rules = MappingRule(
     extras=[
         LetterSequenceRef('letter_sequence'),
         Dictation("text"),
-        ShortIntegerRef('n', 1, 101, default=1)
+        NumberRef('n', 1, 101, default=1, short=True)
     ],
 )
 context = AppContext(executable="outlook")
 outlook_grammar = Grammar("outlook", context=context)
 outlook_grammar.add_rule(rules)
+precompile_static_actions(outlook_grammar)
 outlook_grammar.load()
 
 EXPORT_GRAMMARS = [outlook_grammar]
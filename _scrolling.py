@@ -2,9 +2,11 @@ import time
 from enum import Enum
 from typing import Optional
 
-from dragonfly import MappingRule, Key, Grammar, Mouse, Function, IntegerRef, Choice, get_engine
+from dragonfly import MappingRule, Key, Grammar, Mouse, Function, Choice, get_engine
 from dragonfly.engines.base.timer import Timer
 
+from lib.common import NumberRef
+
 
 class ScrollType(Enum):
     WHEEL_DOWN = Mouse('wheeldown')
@@ -73,7 +75,7 @@ class ScrollingRule(MappingRule):
         'stop': Function(stop_scrolling),
     }
     extras = [
-        IntegerRef('speed', min=1, max=10, default=3),
+        NumberRef('speed', min=1, max=10, default=3),
         Choice('scroll_action', choices={
             'scrolling [down]': ScrollType.WHEEL_DOWN,
             'scrolling up': ScrollType.WHEEL_UP,
@@ -1,6 +1,8 @@
-from dragonfly import MappingRule, Key, Grammar, Text, ShortIntegerRef, Dictation, AppContext
+from dragonfly import MappingRule, Grammar, Dictation, AppContext
 
-from lib.common import LetterSequenceRef, release
+from lib.actions import Key, Text
+from lib.common import LetterSequenceRef, NumberRef, release
+from lib.rules import precompile_static_actions
 
 rules = MappingRule(
     name="slack",
@@ -79,7 +81,7 @@ rules = MappingRule(
     extras=[
         LetterSequenceRef('letter_sequence'),
         Dictation("text"),
-        ShortIntegerRef('n', 1, 101)
+        NumberRef('n', 1, 101, short=True)
     ],
     defaults={
         "n": 1
@@ -88,6 +90,7 @@ rules = MappingRule(
 context = AppContext(executable="slack")
 slack_grammar = Grammar("slack", context=context)
 slack_grammar.add_rule(rules)
+precompile_static_actions(slack_grammar)
 slack_grammar.load()
 
 EXPORT_GRAMMARS = [slack_grammar]
@@ -1,4 +1,6 @@
-from dragonfly import MappingRule, Key, Grammar, IntegerRef
+from dragonfly import MappingRule, Key, Grammar
+
+from lib.common import NumberRef
 
 
 class TaskRule(MappingRule):
@@ -11,7 +13,7 @@ class TaskRule(MappingRule):
         "(minimize | min) task [minus] <n>": Key("space/10,a-space/10,n"),
         "(maximize | max) task [minus] <n>": Key("space/10,a-space/10,x"),
     }
-    extras = [IntegerRef("n", 1, 30)]
+    extras = [NumberRef("n", 1, 30)]
 
     def _process_recognition(self, value, extras):
         node = extras['_node']
@@ -30,7 +32,7 @@ class IconRule(MappingRule):
         "[open] icon <n>": Key("enter"),
         "(menu | pop up) icon <n>": Key("apps"),
     }
-    extras = [IntegerRef("n", 1, 12)]
+    extras = [NumberRef("n", 1, 12)]
 
     def _process_recognition(self, value, extras):
         count = extras["n"] - 1
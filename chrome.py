@@ -1,6 +1,9 @@
-from dragonfly import MappingRule, Key, Text, AppContext, Grammar, Dictation, ShortIntegerRef, Function
+from dragonfly import MappingRule, AppContext, Grammar, Dictation, Function
 
-from lib.common import LetterSequenceRef, release, execute_select
+from lib.actions import Key, Text
+from lib.common import LetterSequenceRef, NumberRef, release, execute_select
+from lib.interning import intern_elements
+from lib.rules import precompile_static_actions
 
 rules = MappingRule(
     name="chrome",
@@ -78,7 +81,7 @@ rules = MappingRule(
     extras=[
         LetterSequenceRef('letter_sequence'),
         Dictation("text"),
-        ShortIntegerRef('n', 1, 101)
+        NumberRef('n', 1, 101, short=True)
     ],
     defaults={
         "n": 1
@@ -87,6 +90,8 @@ rules = MappingRule(
 context = AppContext(executable="chrome")
 chrome_grammar = Grammar("chrome", context=context)
 chrome_grammar.add_rule(rules)
+intern_elements(chrome_grammar)
+precompile_static_actions(chrome_grammar)
 chrome_grammar.load()
 
 EXPORT_GRAMMARS = [chrome_grammar]
@@ -1,7 +1,8 @@
-from dragonfly import MappingRule, Text, Key
+from lib.actions import Key, Text
+from lib.elements import IndexedMappingRule
 
 
-class CPlusPlusRule(MappingRule):
+class CPlusPlusRule(IndexedMappingRule):
     mapping = {
         "assign": Text(" = "),
         "(eek|equal|equals)": Text(" == "),
@@ -1,14 +1,16 @@
 ﻿import enum
 import logging
 from itertools import chain
+from types import MappingProxyType
 from typing import List, Union
 
-from dragonfly import MappingRule, Function, Key, Pause, Repeat, Dictation, IntegerRef, Grammar, CompoundRule, \
-    Rule, RuleRef, Choice, Text, ShortIntegerRef, ElementBase
+from dragonfly import MappingRule, Function, Pause, Repeat, Dictation, Grammar, CompoundRule, Rule, RuleRef, \
+    Choice, ElementBase, Sequence
+from dragonfly.actions.action_base import BoundAction
 
-from lib.actions import MarkedAction
-from lib.common import LetterRef, LetterSequenceRef, single_character_key_map
-from lib.elements import RuleOrElemAlternative
+from lib.actions import BatchedAction, Key, MarkedAction, Text
+from lib.common import LetterRef, LetterSequenceRef, NumberRef, single_character_key_map
+from lib.elements import IndexedChoice, IndexedMappingRule, IndexedRuleOrElemAlternative
 from lib.format import FormatRule
 from lib.grammar_switcher import GrammarSwitcher
 from lib.rules import RepeatActionRule
@@ -63,31 +65,39 @@ class VimGrammarSwitcher(GrammarSwitcher):
         return class_modifier
 
 
+def make_repeat_rule(non_transitions, name=None):
+    """
+    Returns the non-exported rule repeating the non-transition commands of a mode, shared by every rule of the mode.
+    """
+    return RepeatActionRule(IndexedRuleOrElemAlternative(list(non_transitions)), name=name, exported=False,
+                            optimize=fold_count_motions)
+
+
 class TransitionThenRepeatRule(CompoundRule):
     non_transitions: List[Union[Rule, ElementBase]] = []
     transitions: List[Union[Rule, ElementBase]] = []
 
-    def __init__(self, vim_mode_switcher=None, non_transitions=None, transitions=None, name=None, exported=None):
+    def __init__(self, vim_mode_switcher=None, non_transitions=None, transitions=None, name=None, exported=None,
+                 repeat_rule=None):
         if vim_mode_switcher is not None: assert isinstance(vim_mode_switcher, VimGrammarSwitcher)
         self.switcher = vim_mode_switcher
         if non_transitions is None: non_transitions = self.non_transitions
         if transitions is None: transitions = self.transitions
         assert all([not isinstance(x, Rule) or not x.exported for x in non_transitions + transitions])
+        if repeat_rule is None: repeat_rule = make_repeat_rule(non_transitions)
         spec = '<transition_command> [<repeat_command>]'
         extras = [
-            RuleRef(RepeatActionRule(RuleOrElemAlternative(non_transitions), exported=False), name='repeat_command'),
-            RuleOrElemAlternative(transitions, name='transition_command')]
+            RuleRef(repeat_rule, name='repeat_command'),
+            IndexedRuleOrElemAlternative(transitions, name='transition_command')]
         super(TransitionThenRepeatRule, self).__init__(name=name, spec=spec, extras=extras, exported=exported)
 
     def _process_recognition(self, node, extras):
         transition = extras['transition_command']
-        transition.execute()
+        repeat = extras.get('repeat_command', None)
+        BatchedAction(*[a for a in (transition, repeat) if a is not None]).execute()
         if isinstance(transition, MarkedAction):
             mode = transition.mark
             self.switcher.switch_to_mode(mode)
-        repeat = extras.get('repeat_command', None)
-        if repeat is not None:
-            repeat.execute()
 
     def value(self, node):
         transition = node.get_child_by_name('transition_command', shallow=True)
@@ -105,28 +115,27 @@ class RepeatThenTransitionRule(CompoundRule):
     non_transitions: List[Union[Rule, ElementBase]] = []
     transitions: List[Union[Rule, ElementBase]] = []
 
-    def __init__(self, vim_mode_switcher=None, non_transitions=None, transitions=None, name=None, exported=None):
+    def __init__(self, vim_mode_switcher=None, non_transitions=None, transitions=None, name=None, exported=None,
+                 repeat_rule=None):
         if vim_mode_switcher is not None: assert isinstance(vim_mode_switcher, VimGrammarSwitcher)
         self.switcher = vim_mode_switcher
         if non_transitions is None: non_transitions = self.non_transitions
         if transitions is None: transitions = self.transitions
         assert all([not isinstance(x, Rule) or not x.exported for x in non_transitions + transitions])
+        if repeat_rule is None: repeat_rule = make_repeat_rule(non_transitions)
         spec = '(<repeat_command> [<transition_command>]|<transition_command>)'
         extras = [
-            RuleRef(RepeatActionRule(RuleOrElemAlternative(non_transitions), exported=False), name='repeat_command'),
-            RuleOrElemAlternative(transitions, name='transition_command')]
+            RuleRef(repeat_rule, name='repeat_command'),
+            IndexedRuleOrElemAlternative(transitions, name='transition_command')]
         super(RepeatThenTransitionRule, self).__init__(name=name, spec=spec, extras=extras, exported=exported)
 
     def _process_recognition(self, node, extras):
         repeat = extras.get('repeat_command', None)
-        if repeat is not None:
-            repeat.execute()
         transition = extras.get('transition_command', None)
-        if transition is not None:
-            transition.execute()
-            if isinstance(transition, MarkedAction):
-                mode = transition.mark
-                self.switcher.switch_to_mode(mode)
+        BatchedAction(*[a for a in (repeat, transition) if a is not None]).execute()
+        if isinstance(transition, MarkedAction):
+            mode = transition.mark
+            self.switcher.switch_to_mode(mode)
 
     def value(self, node):
         transition = node.get_child_by_name('transition_command', shallow=True)
@@ -161,10 +170,24 @@ text_object_selection_objects = {
     "(quote|singles)": "squote",
     "(backtick|tick|grave)": "backtick",
 }
-text_object_keys = {}
-for sp1, k1 in text_object_selection_exclusive_keys.items():
-    for sp2, k2 in text_object_selection_objects.items():
-        text_object_keys[sp1 + ' ' + sp2] = k1 + ',' + k2
+
+
+class TextObjectRef(Sequence):
+    """
+    Text object spoken as a selection followed by an object, e.g. 'inner paren', whose value is their keys joined by a
+    comma, e.g. 'i,rparen'. The two choices are kept apart, so the grammar grows with the sum of their sizes rather
+    than with their product.
+    """
+
+    def __init__(self, name=None, default=None):
+        children = [IndexedChoice(None, text_object_selection_exclusive_keys),
+                    IndexedChoice(None, text_object_selection_objects)]
+        super(TextObjectRef, self).__init__(children, name=name, default=default)
+
+    def value(self, node):
+        return ','.join(child.value() for child in node.children)
+
+
 paired_symbols_keys = {
     "(bracket|lack|rack)": "lbracket,rbracket",
     "(paren|lip|rip)": "lparen,rparen",
@@ -212,6 +235,35 @@ optional_count_motion_keys = {
     "next": "n",
     "previous": "N",
 }
+optional_count_motion_action = Text('%(n)d') + Key('%(optional_count_motion)s')
+
+
+def _is_count_motion(action):
+    return isinstance(action, BoundAction) and action._action is optional_count_motion_action
+
+
+def _count_motion(action, n):
+    return BoundAction(optional_count_motion_action, dict(action._data, n=n))
+
+
+def fold_count_motions(actions, count):
+    """
+    Merges runs of the same optional count motion into one counted motion, e.g. 'down down' into 2j.
+
+    A sequence that is a single motion also takes the repeat count, so 'down down five times' becomes 10j.
+    """
+    folded = []
+    for action in actions:
+        if folded and _is_count_motion(action) and _is_count_motion(folded[-1]) and \
+                folded[-1]._data['optional_count_motion'] == action._data['optional_count_motion']:
+            folded[-1] = _count_motion(folded[-1], folded[-1]._data['n'] + action._data['n'])
+        else:
+            folded.append(action)
+    if count > 1 and len(folded) == 1 and _is_count_motion(folded[0]):
+        return [_count_motion(folded[0], folded[0]._data['n'] * count)], 1
+    return folded, count
+
+
 mandatory_count_motion_keys = {
     '(bar|pipe|column)': 'bar',
     'go': 'G',
@@ -271,12 +323,12 @@ def swap_quotes_action(n, swap_quotes):
     (Text(str(n)) + Key("dquote,z,d,i," + q1 + ',left,2,r,' + q2 + ',right,dquote,z,P')).execute()
 
 
-class NormalModeCommands(MappingRule):
+class NormalModeCommands(IndexedMappingRule):
     mapping = {
         "kay": Key("escape"),
         "slap": Key('enter'),
 
-        '[<n>] <optional_count_motion>': Text('%(n)d') + Key('%(optional_count_motion)s'),
+        '[<n>] <optional_count_motion>': optional_count_motion_action,
         '<no_count_motion>': Key('%(no_count_motion)s'),
         '<ln> <mandatory_count_motion>': Text('%(ln)d') + Key('%(mandatory_count_motion)s'),
         '[<n>] <find_motion>': Text('%(n)d') + Key('%(find_motion)s'),
@@ -407,15 +459,15 @@ class NormalModeCommands(MappingRule):
     }
     extras = [
         Dictation("text"),
-        IntegerRef("n", 1, 101, default=1),
-        IntegerRef('m', 1, 101, default=1),
-        ShortIntegerRef("ln", 1, 10000, default=1),
-        ShortIntegerRef("lm", 1, 10000, default=1),
+        NumberRef("n", 1, 101, default=1),
+        NumberRef('m', 1, 101, default=1),
+        NumberRef("ln", 1, 10000, default=1, short=True, digits=True),
+        NumberRef("lm", 1, 10000, default=1, short=True, digits=True),
         LetterRef('letter'),
         Choice('no_count_motion', no_count_motion_keys),
         Choice('optional_count_motion', optional_count_motion_keys),
         Choice('mandatory_count_motion', mandatory_count_motion_keys),
-        Choice('text_object_selection', text_object_keys),
+        TextObjectRef('text_object_selection'),
         FindMotionRef('find_motion'),
         Choice('register', register_keys, default='dquote'),
         Choice('paired_symbol', paired_symbol_keys),
@@ -429,7 +481,7 @@ class NormalModeCommands(MappingRule):
 
 
 @VimGrammarSwitcher.mark_switches_to_mode(VimMode.INSERT)
-class NormalModeToInsertModeCommands(MappingRule):
+class NormalModeToInsertModeCommands(IndexedMappingRule):
     mapping = {
         "insert": Key("i"),
         "(shift|big) insert": Key("I"),
@@ -456,10 +508,10 @@ class NormalModeToInsertModeCommands(MappingRule):
         Choice('no_count_motion', no_count_motion_keys),
         Choice('optional_count_motion', optional_count_motion_keys),
         Choice('mandatory_count_motion', mandatory_count_motion_keys),
-        Choice('text_object_selection', text_object_keys),
+        TextObjectRef('text_object_selection'),
         Choice('text_object_selection_object', text_object_selection_objects),
         FindMotionRef('find_motion'),
-        IntegerRef('n', 1, 101, default=1),
+        NumberRef('n', 1, 101, default=1),
     ]
 
 
@@ -505,7 +557,7 @@ class VisualModeToNormalModeCommands(MappingRule):
 
     extras = [
         LetterRef('letter'),
-        IntegerRef('n', min=1, max=30, default=1),
+        NumberRef('n', min=1, max=30, default=1),
         Choice('register', register_keys, default='dquote'),
         Choice('paired_symbols', paired_symbols_keys),
     ]
@@ -518,10 +570,10 @@ class VisualModeToInsertModeCommands(MappingRule):
     }
 
 
-class VisualModeCommands(MappingRule):
+class VisualModeCommands(IndexedMappingRule):
     mapping = {
         "slap": Key('enter'),
-        '[<n>] <optional_count_motion>': Text('%(n)d') + Key('%(optional_count_motion)s'),
+        '[<n>] <optional_count_motion>': optional_count_motion_action,
         '<no_count_motion>': Key('%(no_count_motion)s'),
         '<ln> <mandatory_count_motion>': Text('%(ln)d') + Key('%(mandatory_count_motion)s'),
         '<text_object_selection>': Key('%(text_object_selection)s'),
@@ -565,14 +617,14 @@ class VisualModeCommands(MappingRule):
     }
     extras = [
         Dictation("text"),
-        IntegerRef("n", 1, 101, default=1),
-        ShortIntegerRef("ln", 1, 10000, default=1),
-        ShortIntegerRef("lm", 1, 10000, default=1),
+        NumberRef("n", 1, 101, default=1),
+        NumberRef("ln", 1, 10000, default=1, short=True, digits=True),
+        NumberRef("lm", 1, 10000, default=1, short=True, digits=True),
         LetterRef('letter'),
         Choice('no_count_motion', no_count_motion_keys),
         Choice('optional_count_motion', optional_count_motion_keys),
         Choice('mandatory_count_motion', mandatory_count_motion_keys),
-        Choice('text_object_selection', text_object_keys),
+        TextObjectRef('text_object_selection'),
         FindMotionRef('find_motion'),
         Choice('register', register_keys, default='dquote'),
         Choice('paired_symbol', paired_symbol_keys),
@@ -595,7 +647,7 @@ class InsertModeToNormalModeCommands(MappingRule):
     }
 
 
-class InsertModeCommands(MappingRule):
+class InsertModeCommands(IndexedMappingRule):
     mapping = {
         # "<text>": Text("%(text)s"),
         "<letter_sequence>": Key('%(letter_sequence)s'),
@@ -658,7 +710,7 @@ class InsertModeCommands(MappingRule):
         LetterSequenceRef('letter_sequence'),
         LetterRef('letter'),
         Dictation("text"),
-        IntegerRef("n", 1, 50, default=1),
+        NumberRef("n", 1, 50, default=1),
     ]
 
 
@@ -671,7 +723,7 @@ class ExModeToNormalModeCommands(MappingRule):
     }
 
 
-class ExModeCommands(MappingRule):
+class ExModeCommands(IndexedMappingRule):
     mapping = {
         "read": Text("r "),
         "(write|save) file": Text("w "),
@@ -701,7 +753,7 @@ class ExModeCommands(MappingRule):
     }
     extras = [
         Dictation("text"),
-        IntegerRef("n", 1, 50, default=1),
+        NumberRef("n", 1, 50, default=1),
         LetterSequenceRef('letter_sequence'),
     ]
 
@@ -740,34 +792,123 @@ def transitions_out_of_mode(transitions, mode):
     ))
 
 
-def _make_transition_then_repeats(commands, prefix, transitions):
+def _make_repeat_rules(commands, prefix):
+    return {mode: make_repeat_rule(commands[mode], name=prefix + mode.name.capitalize() + 'RepeatRule')
+            for mode in commands}
+
+
+def _make_transition_then_repeats(commands, prefix, transitions, repeat_rules=None):
+    if repeat_rules is None: repeat_rules = _make_repeat_rules(commands, prefix)
     return {
         (source, destination):
-            [TransitionThenRepeatRule(non_transitions=commands[destination],
-                                      transitions=transitions[(source, destination)],
+            [TransitionThenRepeatRule(non_transitions=list(commands[destination]),
+                                      transitions=list(transitions[(source, destination)]),
                                       name=prefix + source.name.capitalize() + 'To' + destination.name.capitalize() + 'Rule',
-                                      exported=False)]
+                                      exported=False,
+                                      repeat_rule=repeat_rules[destination])]
         for (source, destination) in transitions
     }
 
 
-def _make_mode_rules(commands, grammar_switcher, prefix, transition_then_repeats):
+def _make_mode_rules(commands, grammar_switcher, prefix, transition_then_repeats, repeat_rules=None):
+    if repeat_rules is None: repeat_rules = _make_repeat_rules(commands, prefix)
     return {
         mode: RepeatThenTransitionRule(vim_mode_switcher=grammar_switcher,
-                                       non_transitions=commands[mode],
+                                       non_transitions=list(commands[mode]),
                                        transitions=transitions_out_of_mode(transition_then_repeats, mode),
-                                       name=prefix + mode.name.capitalize() + 'Rule')
+                                       name=prefix + mode.name.capitalize() + 'Rule',
+                                       repeat_rule=repeat_rules[mode])
         for mode in commands
     }
 
 
-def make_vim_grammars(commands, transitions, context=None, prefix=''):
-    transition_then_repeats = _make_transition_then_repeats(commands, prefix, transitions)
+def _make_vim_grammars(commands, transition_then_repeats, context, prefix, repeat_rules=None):
     grammars = {mode: Grammar(prefix + mode.name.capitalize() + 'Mode', context=context) for mode in commands}
 
     grammar_switcher = VimGrammarSwitcher(grammars[VimMode.NORMAL], grammars[VimMode.INSERT], grammars[VimMode.VISUAL],
                                           grammars[VimMode.EX])
-    mode_rules = _make_mode_rules(commands, grammar_switcher, prefix, transition_then_repeats)
+    mode_rules = _make_mode_rules(commands, grammar_switcher, prefix, transition_then_repeats, repeat_rules)
     for mode in commands:
         grammars[mode].add_rule(mode_rules[mode])
     return grammars, grammar_switcher
+
+
+def make_vim_grammars(commands, transitions, context=None, prefix=''):
+    repeat_rules = _make_repeat_rules(commands, prefix)
+    transition_then_repeats = _make_transition_then_repeats(commands, prefix, transitions, repeat_rules)
+    return _make_vim_grammars(commands, transition_then_repeats, context, prefix, repeat_rules)
+
+
+class VimRuleSet(object):
+    """
+    Immutable set of the non-exported vim command, repeat and transition rules.
+
+    Every grammar made from a rule set references the same rule objects, so an IDE only builds its own exported
+    mode rules. Each mode has one repeat rule, referenced by its mode rule and by every transition into the mode. Use
+    with_commands to derive a set with extra rules, e.g. a language rule for insert mode.
+    """
+
+    def __init__(self, commands, transitions, _parent=None, _changed_modes=()):
+        self._commands = MappingProxyType({mode: tuple(rules) for mode, rules in commands.items()})
+        self._transitions = MappingProxyType({pair: tuple(rules) for pair, rules in transitions.items()})
+        self._parent = _parent
+        self._changed_modes = frozenset(_changed_modes)
+        self._repeat_rules = {}
+        self._transition_then_repeats = {}
+
+    @property
+    def commands(self):
+        return self._commands
+
+    @property
+    def transitions(self):
+        return self._transitions
+
+    def repeat_rule(self, mode):
+        """Returns the shared repeat rule of the commands of the mode, building it on first use."""
+        if mode not in self._repeat_rules:
+            if self._parent is not None and mode not in self._changed_modes:
+                rule = self._parent.repeat_rule(mode)
+            else:
+                rule = make_repeat_rule(self._commands[mode], name=mode.name.capitalize() + 'RepeatRule')
+            self._repeat_rules[mode] = rule
+        return self._repeat_rules[mode]
+
+    def transition_then_repeat_rules(self, source, destination):
+        """Returns the shared transition then repeat rules from source to destination, building them on first use."""
+        pair = (source, destination)
+        if pair not in self._transition_then_repeats:
+            if self._parent is not None and destination not in self._changed_modes:
+                rules = self._parent.transition_then_repeat_rules(source, destination)
+            else:
+                rules = _make_transition_then_repeats(self._commands, '', {pair: self._transitions[pair]},
+                                                      {destination: self.repeat_rule(destination)})[pair]
+            self._transition_then_repeats[pair] = tuple(rules)
+        return self._transition_then_repeats[pair]
+
+    def with_commands(self, extra_commands):
+        """
+        :param extra_commands: dict from vim mode to non-exported rules to add to that mode
+        :return: new rule set sharing every rule that the extra commands do not change
+        """
+        assert all(not isinstance(x, Rule) or not x.exported for rules in extra_commands.values() for x in rules)
+        changed_modes = [mode for mode, rules in extra_commands.items() if rules]
+        commands = {mode: rules + tuple(extra_commands[mode]) if mode in changed_modes else rules
+                    for mode, rules in self._commands.items()}
+        return VimRuleSet(commands, self._transitions, _parent=self, _changed_modes=changed_modes)
+
+    def make_grammars(self, context=None, prefix=''):
+        transition_then_repeats = {pair: list(self.transition_then_repeat_rules(*pair)) for pair in self._transitions}
+        repeat_rules = {mode: self.repeat_rule(mode) for mode in self._commands}
+        return _make_vim_grammars(self._commands, transition_then_repeats, context, prefix, repeat_rules)
+
+
+_shared_vim_rule_set = None
+
+
+def get_shared_vim_rule_set():
+    """Returns the rule set of the default vim commands and transitions, which is built once per process."""
+    global _shared_vim_rule_set
+    if _shared_vim_rule_set is None:
+        _shared_vim_rule_set = VimRuleSet(get_commands(), get_transitions())
+    return _shared_vim_rule_set
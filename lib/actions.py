@@ -1,4 +1,11 @@
-from dragonfly import ActionBase
+import copy
+from collections import OrderedDict
+from threading import Lock
+
+import dragonfly
+from dragonfly import ActionBase, Pause, Repeat
+from dragonfly.actions.action_base import ActionError, ActionRepetition, ActionSeries, BoundAction
+from dragonfly.actions.action_base_keyboard import BaseKeyboardAction
 
 
 class EmptyAction(ActionBase):
@@ -15,3 +22,240 @@ class MarkedAction(ActionBase):
 
     def execute(self, data=None):
         return self.action.execute(data)
+
+
+class RepeatedAction(ActionBase):
+    """Executes a sequence of actions count times without building the expanded series."""
+
+    def __init__(self, actions, count=1):
+        assert all(isinstance(action, ActionBase) for action in actions)
+        assert count >= 0
+        super(RepeatedAction, self).__init__()
+        self.actions = tuple(actions)
+        self.count = count
+        self._str = '%s, %d' % (', '.join(str(action) for action in self.actions), count)
+
+    @property
+    def expanded_length(self):
+        return len(self.actions) * self.count
+
+    def _execute(self, data=None):
+        for _ in range(self.count):
+            for action in self.actions:
+                if action.execute(data) is False:
+                    return False
+        return True
+
+
+class _KeyboardEventBuffer(object):
+    """Stands in for the keyboard of keyboard actions and collects their events instead of sending them."""
+
+    def __init__(self, keyboard):
+        self.keyboard = keyboard
+        self.events = []
+
+    def __getattr__(self, name):
+        return getattr(self.keyboard, name)
+
+    def send_keyboard_events(self, events):
+        self.events.extend(events)
+
+    def add_pause(self, interval):
+        if not self.events:
+            return False
+        event = self.events[-1]
+        self.events[-1] = event[:2] + (event[2] + interval,) + event[3:]
+        return True
+
+    def flush(self):
+        if self.events:
+            events, self.events = self.events, []
+            self.keyboard.send_keyboard_events(events)
+
+
+def _sending_to(action, keyboard):
+    """
+    :param action: keyboard action
+    :param keyboard: keyboard to send the events of the action to
+    :return: copy of the action that sends its events to keyboard instead of the keyboard shared by all actions
+    """
+    action = copy.copy(action)
+    action._keyboard = keyboard
+    return action
+
+
+class CompiledKeys(ActionBase):
+    """Frozen keyboard events of a static action, sent with a single keyboard call."""
+
+    _hardware_probe = dragonfly.Key()
+
+    def __init__(self, action, software_events, hardware_events):
+        super(CompiledKeys, self).__init__()
+        self.action = action
+        self.software_events = software_events
+        self.hardware_events = hardware_events
+        self._str = str(action)
+
+    def events(self):
+        return self.hardware_events if self._hardware_probe.require_hardware_events() else self.software_events
+
+    def bind(self, data=None):
+        return self
+
+    def copy_bind(self, data=None):
+        return self
+
+    def _execute(self, data=None):
+        BaseKeyboardAction._keyboard.send_keyboard_events(self.events())
+        return True
+
+
+def _collect_static_events(action, use_hardware, buffer):
+    if isinstance(action, EmptyAction):
+        return True
+    if isinstance(action, CompiledKeys):
+        buffer.send_keyboard_events(action.hardware_events if use_hardware else action.software_events)
+        return True
+    if isinstance(action, ActionSeries) and action.stop_on_failures:
+        return all(_collect_static_events(child, use_hardware, buffer) for child in action._actions)
+    if isinstance(action, ActionRepetition) and isinstance(action._factor, int):
+        return all(_collect_static_events(action._action, use_hardware, buffer) for _ in range(action._factor))
+    if isinstance(action, Pause) and action._static:
+        return buffer.add_pause(action._events)
+    if isinstance(action, (dragonfly.Key, dragonfly.Text)) and action._static and \
+            not getattr(action, '_autofmt', False):
+        hardware = use_hardware or action._use_hardware
+        action = _sending_to(action, buffer)
+        action.require_hardware_events = lambda: hardware
+        action._execute_events(action._events)
+        return True
+    return False
+
+
+def compile_static_action(action):
+    """
+    :param action: action to compile
+    :return: CompiledKeys with the keyboard events of the action, or None if the action depends on data or does
+        anything besides typing keys and pausing
+    """
+    compiled = []
+    for use_hardware in (False, True):
+        buffer = _KeyboardEventBuffer(BaseKeyboardAction._keyboard)
+        try:
+            if not _collect_static_events(action, use_hardware, buffer):
+                return None
+        except ActionError:
+            return None
+        compiled.append(tuple(buffer.events))
+    return CompiledKeys(action, *compiled)
+
+
+class BatchedAction(ActionSeries):
+    """
+    Series of actions whose keyboard events are sent in as few keyboard calls as possible.
+
+    Key and Text events are collected in order and pauses are folded into the timeout of the preceding event. Any
+    other action first sends the events collected so far and is then executed as usual.
+    """
+
+    def _execute(self, data=None):
+        buffer = _KeyboardEventBuffer(BaseKeyboardAction._keyboard)
+        try:
+            return self._execute_batched(self, data, buffer)
+        finally:
+            buffer.flush()
+
+    def _execute_batched(self, action, data, buffer):
+        if isinstance(action, EmptyAction):
+            return True
+        if isinstance(action, MarkedAction):
+            return self._execute_batched(action.action, data, buffer)
+        if isinstance(action, CompiledKeys):
+            buffer.send_keyboard_events(action.events())
+            return True
+        if isinstance(action, BoundAction):
+            bound_data = dict(data) if data else {}
+            bound_data.update(action._data or {})
+            return self._execute_batched(action._action, bound_data, buffer)
+        if isinstance(action, ActionSeries):
+            for child in action._actions:
+                if self._execute_batched(child, data, buffer) is False and action.stop_on_failures:
+                    return False
+            return True
+        if isinstance(action, RepeatedAction):
+            for _ in range(action.count):
+                for child in action.actions:
+                    if self._execute_batched(child, data, buffer) is False:
+                        return False
+            return True
+        if isinstance(action, ActionRepetition):
+            factor = action._factor
+            repeat = factor.factor(data) if isinstance(factor, Repeat) else factor
+            for _ in range(repeat):
+                if self._execute_batched(action._action, data, buffer) is False:
+                    return False
+            return True
+        if isinstance(action, Pause):
+            try:
+                interval = action._events if action._static else action._parse_spec(action._spec % (data or {}))
+            except (KeyError, TypeError, ValueError):
+                interval = None
+            if interval is not None and buffer.add_pause(interval):
+                return True
+        elif isinstance(action, BaseKeyboardAction) and not getattr(action, '_autofmt', False):
+            return _sending_to(action, buffer).execute(data)
+        buffer.flush()
+        return action.execute(data)
+
+
+class SpecCache(object):
+    """Bounded least recently used cache from fully bound Key and Text specs to their parsed events."""
+
+    def __init__(self, max_size=2048):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def parse(self, action, spec, parse_spec):
+        key = (action.__class__, spec)
+        with self._lock:
+            events = self._entries.get(key)
+            if events is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return events
+            self.misses += 1
+        events = tuple(parse_spec(spec))
+        with self._lock:
+            self._entries[key] = events
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return events
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+spec_cache = SpecCache()
+
+
+class Key(dragonfly.Key):
+    """Key action whose specs are parsed through the shared spec cache."""
+
+    def _parse_spec(self, spec):
+        return spec_cache.parse(self, spec, super(Key, self)._parse_spec)
+
+
+class Text(dragonfly.Text):
+    """Text action whose specs are parsed through the shared spec cache."""
+
+    def _parse_spec(self, spec):
+        return spec_cache.parse(self, spec, super(Text, self)._parse_spec)
@@ -1,4 +1,10 @@
-from dragonfly import Key, Choice, Modifier, Repetition, MappingRule
+from typing import Dict, Tuple
+
+from dragonfly import Alternative, Integer, Repetition, MappingRule, Rule, RuleRef
+from dragonfly.language.loader import language
+
+from lib.actions import Key
+from lib.elements import IndexedChoice, first_words, spoken_phrases
 
 release = Key("shift:up, ctrl:up")
 
@@ -95,19 +101,136 @@ single_character_key_map.update(digits_key_map)
 single_character_key_map.update(special_character_key_map)
 
 
-class LetterRef(Choice):
+class LetterRef(IndexedChoice):
     def __init__(self, name=None, default=None):
         super(LetterRef, self).__init__(name, single_character_key_map, default=default)
 
 
-class LetterSequenceRef(Modifier):
+class LetterSequence(Repetition):
+    """
+    Repetition of a LetterRef that decodes with a single scan over the words and a lookup table from spoken words to
+    keys, instead of nesting an optional for every letter. Its value is the keys of the letters joined by commas.
+
+    The letters are matched longest phrase first, and sequences are yielded longest first like a greedy Repetition.
+    It is compiled like any Repetition, which Natlink sends to Dragon as a single repetition of the letters.
+    """
+
+    def __init__(self, name=None, min=1, max=32, default=None):
+        letter = LetterRef()
+        super(LetterSequence, self).__init__(letter, min=min, max=max, name=name, default=default)
+        self._keys = {}
+        for compound in letter.children:
+            for phrase in spoken_phrases(compound):
+                self._keys.setdefault(phrase, compound.value(None))
+        self._phrase_lengths = sorted({len(phrase) for phrase in self._keys}, reverse=True)
+
+    def first_words(self, visiting):
+        return first_words(self._child, visiting)
+
+    def _match(self, results, index):
+        """Returns the key and the number of words of the longest letter starting at the index of the results."""
+        for length in self._phrase_lengths:
+            phrase = tuple(result[0].lower() for result in results[index:index + length])
+            if len(phrase) == length and phrase in self._keys:
+                return self._keys[phrase], length
+        return None
+
+    def decode(self, state):
+        state.decode_attempt(self)
+        ends = [state._index]
+        while len(ends) < self._max:
+            match = self._match(state._results, ends[-1])
+            if match is None:
+                break
+            ends.append(ends[-1] + match[1])
+        for count in range(len(ends) - 1, self._min - 1, -1):
+            state._index = ends[count]
+            state.decode_success(self)
+            yield state
+            state.decode_retry(self)
+        state.decode_failure(self)
+
+    def value(self, node):
+        results = node.full_results()
+        keys = []
+        index = 0
+        while index < len(results):
+            key, length = self._match(results, index)
+            keys.append(key)
+            index += length
+        return ','.join(keys)
+
+
+class LetterSequenceRef(LetterSequence):
     def __init__(self, name):
-        element = Repetition(LetterRef(), min=1, max=32, name=name)
-
-        def modifier(v):
-            return ','.join(v)
-
-        super(LetterSequenceRef, self).__init__(element, modifier)
+        super(LetterSequenceRef, self).__init__(name=name)
+
+
+class DigitSequence(Repetition):
+    """
+    Number spoken digit by digit, e.g. 'one two three' for 123, whose value is in the range [min, max).
+
+    Like LetterSequence, it decodes with a single scan over the words and yields the longest number first. A number of
+    more than one digit cannot start with zero.
+    """
+
+    def __init__(self, name=None, min=0, max=10, default=None):
+        assert min < max
+        self._min_value = min
+        self._max_value = max
+        super(DigitSequence, self).__init__(IndexedChoice(None, digits_key_map), min=1, max=len(str(max - 1)) + 1,
+                                            name=name, default=default)
+
+    def first_words(self, visiting):
+        return first_words(self._child, visiting)
+
+    def decode(self, state):
+        state.decode_attempt(self)
+        begin = state._index
+        digits = ''
+        while len(digits) + 1 < self._max:
+            digit = digits_key_map.get((state.word(len(digits)) or '').lower())
+            if digit is None:
+                break
+            digits += digit
+        longest = 1 if digits.startswith('0') else len(digits)
+        for count in range(longest, 0, -1):
+            if self._min_value <= int(digits[:count]) < self._max_value:
+                state._index = begin + count
+                state.decode_success(self)
+                yield state
+                state.decode_retry(self)
+        state.decode_failure(self)
+
+    def value(self, node):
+        return int(''.join(digits_key_map[word.lower()] for word in node.words()))
+
+
+_number_rules: Dict[Tuple[int, int, bool, bool], Rule] = {}
+
+
+def _number_rule(min, max, short, digits):
+    key = (min, max, short, digits)
+    if key not in _number_rules:
+        element = Integer(None, min, max, content=language.ShortIntegerContent if short else language.IntegerContent)
+        if digits:
+            element = Alternative([element, DigitSequence(None, min, max)])
+        name = '_Number_%d_%d%s%s' % (min, max, '_short' if short else '', '_digits' if digits else '')
+        _number_rules[key] = Rule(name, element, exported=False)
+    return _number_rules[key]
+
+
+class NumberRef(RuleRef):
+    """
+    Reference to the number rule of a range, which is built once and shared by every NumberRef of that range, in
+    place of IntegerRef and ShortIntegerRef which build a new rule each.
+
+    :param short: also accept the short forms of ShortIntegerRef, e.g. 'one fifty' for 150
+    :param digits: also accept the number spoken digit by digit
+    """
+
+    def __init__(self, name, min, max, default=None, short=False, digits=False):
+        super(NumberRef, self).__init__(_number_rule(min, max, short, digits), name=name, default=default)
 
 
 class SpellLetterSequenceRule(MappingRule):
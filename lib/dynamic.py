@@ -0,0 +1,340 @@
+import time
+import weakref
+from functools import lru_cache
+from threading import get_ident
+
+from dragonfly import AppContext, Context, RecognitionObserver, Window, get_engine
+from dragonfly.grammar.context import LogicAndContext, LogicNotContext, LogicOrContext
+
+from lib.rules import bind_shared_rules
+from log import logger
+
+
+def foreground_window():
+    window = Window.get_foreground()
+    return window.executable, window.title, window.handle
+
+
+class MemoizedContext(Context):
+    """Wraps a context and remembers its match result for each (executable, title, handle)."""
+
+    def __init__(self, context, max_size=256):
+        super(MemoizedContext, self).__init__()
+        self.context = context
+        self._str = str(context)
+        self._cached_matches = lru_cache(maxsize=max_size)(context.matches)
+
+    def matches(self, executable, title, handle):
+        return self._cached_matches(executable, title, handle)
+
+    def cache_info(self):
+        return self._cached_matches.cache_info()
+
+
+# Keyed by id(context): a wrapper keeps its context alive, so the id is not reused while the entry exists, and the
+# entry goes away with the last wrapper in use.
+_memoized_contexts: 'weakref.WeakValueDictionary[int, MemoizedContext]' = weakref.WeakValueDictionary()
+
+
+def depends_only_on_window(context):
+    """
+    :return: whether the match result of the context depends on nothing but the executable, title and handle, so that
+        it can be memoized
+    """
+    if isinstance(context, (AppContext, MemoizedContext)):
+        return True
+    if isinstance(context, DynamicContext):
+        return context.memoized
+    if isinstance(context, (LogicAndContext, LogicOrContext)):
+        return all(depends_only_on_window(child) for child in context._children)
+    if isinstance(context, LogicNotContext):
+        return depends_only_on_window(context._child)
+    return False
+
+
+def memoize_context(context):
+    """
+    Returns the memoized wrapper of the context, which is shared by every caller with the same context object.
+    Contexts that depend on more than the window, e.g. a FuncContext, are returned as they are.
+    """
+    if context is None or isinstance(context, MemoizedContext) or not depends_only_on_window(context):
+        return context
+    memoized = _memoized_contexts.get(id(context))
+    if memoized is None:
+        memoized = _memoized_contexts[id(context)] = MemoizedContext(context)
+    return memoized
+
+
+class DynamicContext(Context):
+    def __init__(self, fallback, focus_context):
+        super(DynamicContext, self).__init__()
+        self.fallback = memoize_context(fallback)
+        self.focus_context = memoize_context(focus_context)
+        self.memoized = all(context is None or depends_only_on_window(context)
+                            for context in (self.fallback, self.focus_context))
+        self._cached_matches = lru_cache(maxsize=256)(self._matches) if self.memoized else self._matches
+
+    def matches(self, executable, title, handle):
+        return self._cached_matches(executable, title, handle)
+
+    def _matches(self, executable, title, handle):
+        if not self.is_dynamic_active(executable, title, handle):
+            return self.fallback.matches(executable, title, handle) if self.fallback is not None else True
+        return True
+
+    def is_dynamic_active(self, executable, title, handle):
+        if self.focus_context is None:
+            return True
+        return self.focus_context.matches(executable, title, handle)
+
+
+def states_to_bitmap(states):
+    """Packs a list of grammar enabled states into an int whose bit i is the state of grammar i."""
+    return sum(1 << index for index, enabled in enumerate(states) if enabled)
+
+
+class DeferredGrammars(object):
+    """
+    Grammars of a module that are built and loaded the first time a window matching the context is in the foreground.
+
+    The grammars list is filled in place when the grammars are built, so it can be handed out before that. If
+    idle_unload_seconds is given, the grammars are unloaded at the first update at least that long after a matching
+    window was last in the foreground, and loaded again, without building them again, when one is. While pinned, the
+    grammars are kept loaded whatever the foreground window.
+
+    Grammars are only loaded and unloaded on the engine thread, taken to be the thread creating the DeferredGrammars.
+    An update from another thread, e.g. from a ForegroundWatcher whose engine runs timers on their own thread, only
+    sets pending, and is left to the next update on the engine thread, e.g. when the next recognition begins. Natlink
+    runs timers on the engine thread, so there the grammars are never built while a recognition begins.
+    """
+
+    def __init__(self, context, build, idle_unload_seconds=None, clock=time.monotonic):
+        """
+        :param build: function returning the grammars, not yet loaded
+        """
+        self.context = memoize_context(context)
+        self.build = build
+        self.idle_unload_seconds = idle_unload_seconds
+        self.clock = clock
+        self.grammars = []
+        self.built = False
+        self.loaded = False
+        self.pinned = False
+        self.pending = False
+        self.on_load = []
+        self._last_active = None
+        self._thread = get_ident()
+
+    def load(self):
+        """Builds the grammars if needed, loads them and calls every on_load callback with them."""
+        self._last_active = self.clock()
+        if self.loaded:
+            return
+        if not self.built:
+            self.grammars.extend(self.build())
+            self.built = True
+        for grammar in self.grammars:
+            bind_shared_rules(grammar)
+            grammar.load()
+        self.loaded = True
+        for callback in self.on_load:
+            callback(self.grammars)
+
+    def unload(self):
+        if self.loaded:
+            for grammar in self.grammars:
+                grammar.unload()
+            self.loaded = False
+
+    def update(self, executable, title, handle):
+        """Loads the grammars for a matching foreground window, or unloads them once they were idle long enough."""
+        if get_ident() != self._thread:
+            self.pending = True
+            return
+        self.pending = False
+        if self.pinned or self.context.matches(executable, title, handle):
+            self.load()
+        elif self.loaded and self.idle_unload_seconds is not None and \
+                self.clock() - self._last_active >= self.idle_unload_seconds:
+            logger.info('unloading grammars %s, idle for %s seconds', ', '.join(g.name for g in self.grammars),
+                        self.idle_unload_seconds)
+            self.unload()
+
+
+class DynamicGrammarStateManager(RecognitionObserver):
+    """
+    Switches the grammars of dynamic modules between their static states and their states in the dynamic context.
+
+    Grammar states of a module are kept as bitmaps, and only grammars whose enabled state differs from the wanted
+    state are enabled or disabled. The grammars of modules with deferred grammars are loaded by update, e.g. from a
+    ForegroundWatcher, when the foreground window needs them, or when the module is enabled, and are kept loaded while
+    it is. When a recognition begins, only the grammar states are switched, and deferred grammars are only loaded if
+    an update could not load them on the engine thread.
+    """
+
+    def __init__(self, grammars_grouped_by_module, modules_by_name, dynamic_context, deferred_grammars=None):
+        """
+        :param deferred_grammars: dict from module name to the DeferredGrammars of the module, whose grammars list is
+            also the grammars of the module in grammars_grouped_by_module
+        """
+        super(DynamicGrammarStateManager, self).__init__()
+        self.is_dynamic_active = False
+        self.context = dynamic_context
+        self.grammars_grouped_by_module = grammars_grouped_by_module
+        self.modules_by_name = modules_by_name
+        self.static_grammar_states = self.get_current_grammar_states()
+        self.states_to_restore_on_window_focus = {name: 0 for name in grammars_grouped_by_module}
+        self.states_to_restore_on_manual_enable = self.get_current_grammar_states()
+        self.module_is_enabled = {name: False for name in grammars_grouped_by_module}
+        self.engine_calls = 0
+        self.deferred_grammars = deferred_grammars if deferred_grammars is not None else {}
+        self._built_modules = set()
+        for name, deferred in self.deferred_grammars.items():
+            deferred.on_load.append(lambda grammars, module_name=name: self.grammars_loaded(module_name))
+
+    def dynamic_enable(self, module_name):
+        logger.info("dynamic enable " + module_name)
+        if self.module_is_enabled[module_name]:
+            return
+        self.module_is_enabled[module_name] = True
+        if module_name in self.deferred_grammars:
+            self.deferred_grammars[module_name].pinned = True
+            self.deferred_grammars[module_name].load()
+        calls = self.apply_states_to_grammars(self.grammars_grouped_by_module[module_name],
+                                              self.states_to_restore_on_manual_enable[module_name])
+        for name in self.grammars_grouped_by_module:
+            if name == module_name:
+                continue
+            calls += self.dynamic_disable(name)
+        logger.info('dynamic enable %s made %d grammar calls', module_name, calls)
+
+    def dynamic_disable(self, module_name):
+        if not self.module_is_enabled[module_name]:
+            return 0
+        logger.info("dynamic disable " + module_name)
+        self.module_is_enabled[module_name] = False
+        if module_name in self.deferred_grammars:
+            self.deferred_grammars[module_name].pinned = False
+        grammars = self.grammars_grouped_by_module[module_name]
+        self.states_to_restore_on_manual_enable[module_name] = states_to_bitmap(g.enabled for g in grammars)
+        return self.apply_states_to_grammars(grammars, 0)
+
+    def grammars_loaded(self, module_name):
+        """
+        Applies the states that the deferred grammars of the module, which were just loaded, need. When they were just
+        built, their states are taken as the states of the module first.
+        """
+        grammars = self.grammars_grouped_by_module[module_name]
+        if module_name not in self._built_modules:
+            self._built_modules.add(module_name)
+            states = states_to_bitmap(grammar.enabled for grammar in grammars)
+            self.static_grammar_states[module_name] = states
+            self.states_to_restore_on_manual_enable[module_name] = states
+        if not self.module_is_enabled[module_name]:
+            self.apply_states_to_grammars(grammars, 0 if self.is_dynamic_active
+                                          else self.static_grammar_states[module_name])
+
+    def get_current_grammar_states(self):
+        return {name: states_to_bitmap(grammar.enabled for grammar in grammars)
+                for name, grammars in self.grammars_grouped_by_module.items()}
+
+    def on_begin(self):
+        window = foreground_window()
+        self.switch_states(*window)
+        for deferred in self.deferred_grammars.values():
+            if deferred.pending:
+                deferred.update(*window)
+
+    def update(self, executable, title, handle):
+        """Switches the grammar states, then loads or unloads the deferred grammars, for the foreground window."""
+        self.switch_states(executable, title, handle)
+        self.update_deferred_grammars(executable, title, handle)
+
+    def update_deferred_grammars(self, executable, title, handle):
+        for deferred in self.deferred_grammars.values():
+            deferred.update(executable, title, handle)
+
+    def switch_states(self, executable, title, handle):
+        """Applies the static or the dynamic grammar states, whichever the foreground window needs."""
+        is_dynamic_active = self.context.is_dynamic_active(executable, title, handle)
+        if self.is_dynamic_active and not is_dynamic_active:
+            self.is_dynamic_active = False
+            self.states_to_restore_on_window_focus = self.get_current_grammar_states()
+            calls = self.set_current_grammar_states(self.static_grammar_states)
+            logger.info('leaving dynamic context made %d grammar calls', calls)
+        elif not self.is_dynamic_active and is_dynamic_active:
+            self.is_dynamic_active = True
+            self.static_grammar_states = self.get_current_grammar_states()
+            calls = self.set_current_grammar_states(self.states_to_restore_on_window_focus)
+            logger.info('entering dynamic context made %d grammar calls', calls)
+
+    def apply_states_to_grammars(self, grammars, states):
+        """
+        :param grammars: grammars of one module
+        :param states: bitmap of the wanted enabled states
+        :return: number of grammars enabled or disabled
+        """
+        calls = 0
+        for index, grammar in enumerate(grammars):
+            enabled = bool(states >> index & 1)
+            if grammar.enabled == enabled:
+                continue
+            if enabled:
+                grammar.enable()
+            else:
+                grammar.disable()
+            calls += 1
+        self.engine_calls += calls
+        return calls
+
+    def set_current_grammar_states(self, grammar_states):
+        return sum(self.apply_states_to_grammars(grammars, grammar_states[name])
+                   for name, grammars in self.grammars_grouped_by_module.items())
+
+
+class ForegroundWatcher(object):
+    """
+    Polls the foreground window on an engine timer and calls callback(executable, title, handle) when it changes.
+
+    The polling interval starts at min_interval after a change and grows by backoff up to max_interval while the
+    foreground window stays the same.
+    """
+
+    def __init__(self, callback, window_provider=foreground_window, min_interval=0.05, max_interval=1.0, backoff=1.5):
+        assert 0 < min_interval <= max_interval and backoff >= 1
+        self.callback = callback
+        self.window_provider = window_provider
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        self.last_window = None
+        self._timer = None
+
+    def poll(self):
+        """Checks the foreground window once, returns whether it changed."""
+        window = tuple(self.window_provider())
+        changed = window != self.last_window
+        if changed:
+            self.last_window = window
+            self.interval = self.min_interval
+            self.callback(*window)
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+        if self._timer is not None:
+            # The timer sets its next call time before calling poll, so the new interval is applied to it here.
+            self._timer.interval = self.interval
+            if self._timer.next_time is not None:
+                self._timer.next_time = time.time() + self.interval
+        return changed
+
+    def start(self, engine=None):
+        if self._timer is None:
+            if engine is None:
+                engine = get_engine()
+            self._timer = engine.create_timer(self.poll, self.interval)
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.stop()
+            self._timer = None
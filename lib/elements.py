@@ -1,4 +1,162 @@
-from dragonfly import Alternative, RuleRef, ElementBase, Rule
+from collections import deque
+
+from dragonfly import Alternative, RuleRef, ElementBase, Rule, Choice, MappingRule, Literal, Sequence, Optional, \
+    Empty, Impossible, Repetition
+from dragonfly.grammar.state import State
+
+_structural_decodes = {cls.decode: cls
+                       for cls in (Alternative, Sequence, Optional, Literal, RuleRef, Empty, Impossible)}
+
+
+def first_words(element, _visiting=None):
+    """
+    Computes the words that a decoding of the element can start with.
+
+    :return: (set of lower case words, whether the element can match no words), or None if the first words are unknown
+        (e.g. dictation, lists or elements with custom decoding)
+    """
+    if _visiting is None:
+        _visiting = set()
+    if hasattr(type(element), 'first_words'):
+        return element.first_words(_visiting)
+    kind = Alternative if isinstance(element, FirstWordIndexMixin) else _structural_decodes.get(type(element).decode)
+    if kind is Literal:
+        if not element.words:
+            return set(), True
+        return {element.words[0].lower(), element.words_ext[0].lower()}, False
+    if kind is Empty:
+        return set(), True
+    if kind is Impossible:
+        return set(), False
+    if kind is RuleRef:
+        rule = element.rule
+        if rule in _visiting or rule.element is None:
+            return None
+        _visiting.add(rule)
+        try:
+            return first_words(rule.element, _visiting)
+        finally:
+            _visiting.discard(rule)
+    if kind is Optional:
+        child = first_words(element.children[0], _visiting)
+        return None if child is None else (child[0], True)
+    if kind is Sequence:
+        words = set()
+        for child in element.children:
+            child_first = first_words(child, _visiting)
+            if child_first is None:
+                return None
+            words |= child_first[0]
+            if not child_first[1]:
+                return words, False
+        return words, True
+    if kind is Alternative:
+        words = set()
+        nullable = not element.children
+        for child in element.children:
+            child_first = first_words(child, _visiting)
+            if child_first is None:
+                return None
+            words |= child_first[0]
+            nullable = nullable or child_first[1]
+        return words, nullable
+    return None
+
+
+def spoken_phrases(element):
+    """
+    Expands an element made only of literals, alternatives, optionals and sequences into every phrase it matches.
+
+    :return: set of tuples of lower case words, or None if the element contains anything else
+    """
+    kind = Alternative if isinstance(element, FirstWordIndexMixin) else _structural_decodes.get(type(element).decode)
+    if kind is Literal:
+        return {tuple(word.lower() for word in element.words)}
+    if kind is Empty:
+        return {()}
+    if kind is Optional:
+        child = spoken_phrases(element.children[0])
+        return None if child is None else child | {()}
+    if kind is Sequence:
+        phrases = {()}
+        for child in element.children:
+            child_phrases = spoken_phrases(child)
+            if child_phrases is None:
+                return None
+            phrases = {phrase + child_phrase for phrase in phrases for child_phrase in child_phrases}
+        return phrases
+    if kind is Alternative:
+        phrases = set()
+        for child in element.children:
+            child_phrases = spoken_phrases(child)
+            if child_phrases is None:
+                return None
+            phrases |= child_phrases
+        return phrases
+    return None
+
+
+class FirstWordIndexMixin(object):
+    """
+    Alternative mixin that only tries the children whose first words can match the next word.
+
+    Children that can match no words or whose first words are unknown are always tried. Children are tried in their
+    original order, so the decoding is the same as the plain alternative. The index is built on the first decode.
+    """
+
+    _first_word_index = None
+    _always_tried = None
+
+    def _build_first_word_index(self):
+        always = []
+        by_word = {}
+        for i, child in enumerate(self.children):
+            child_first = first_words(child)
+            if child_first is None or child_first[1]:
+                always.append(i)
+            if child_first is not None:
+                for word in child_first[0]:
+                    by_word.setdefault(word, []).append(i)
+        self._always_tried = tuple(self.children[i] for i in always)
+        self._first_word_index = {word: tuple(self.children[i] for i in sorted(set(indexes + always)))
+                                  for word, indexes in by_word.items()}
+
+    def candidate_children(self, word):
+        if self._first_word_index is None:
+            self._build_first_word_index()
+        if word is None:
+            return self._always_tried
+        return self._first_word_index.get(word.lower(), self._always_tried)
+
+    def decode(self, state):
+        if not self.children:
+            yield from super(FirstWordIndexMixin, self).decode(state)
+            return
+        state.decode_attempt(self)
+        for child in self.candidate_children(state.word()):
+            for _ in child.decode(state):
+                state.decode_success(self)
+                yield state
+                state.decode_retry(self)
+            state.decode_rollback(self)
+        state.decode_failure(self)
+
+
+class IndexedAlternative(FirstWordIndexMixin, Alternative):
+    pass
+
+
+class IndexedChoice(FirstWordIndexMixin, Choice):
+    pass
+
+
+class IndexedMappingRule(MappingRule):
+    """MappingRule whose spoken forms are dispatched on their first word."""
+
+    def __init__(self, *args, **kwargs):
+        super(IndexedMappingRule, self).__init__(*args, **kwargs)
+        if self._element is not None:
+            self._element = IndexedAlternative(self._element.children)
 
 
 class RuleOrElemAlternative(Alternative):
@@ -12,6 +170,57 @@ class RuleOrElemAlternative(Alternative):
         super(RuleOrElemAlternative, self).__init__(children, name, default)
 
 
+class IndexedRuleOrElemAlternative(FirstWordIndexMixin, RuleOrElemAlternative):
+    pass
+
+
+class Memoized(Alternative):
+    """
+    Remembers the decodings of its child at each word position during one recognition.
+
+    Later decodes at the same position replay the recorded parse frames instead of decoding the child again, and a
+    position where the child failed fails immediately. Only positions whose decodings were exhausted are remembered.
+    """
+
+    def __init__(self, element, name=None, default=None):
+        self._element = element
+        super(Memoized, self).__init__((element,), name=name, default=default)
+
+    def first_words(self, visiting):
+        return first_words(self._element, visiting)
+
+    def decode(self, state):
+        memo = state.__dict__.setdefault('_decode_memo', {})
+        key = (id(self), state._index)
+        state.decode_attempt(self)
+        frame_index = len(state._stack)
+        depth = state._depth
+        decodings = memo.get(key)
+        if decodings is None:
+            decodings = []
+            for _ in self._element.decode(state):
+                frames = [(f.depth - depth, f.actor, f.begin, f.end) for f in state._stack[frame_index:]]
+                decodings.append((state._index, frames))
+                state.decode_success(self)
+                yield state
+                state.decode_retry(self)
+            memo[key] = decodings
+        else:
+            begin = state._index
+            for end, frames in decodings:
+                for relative_depth, actor, frame_begin, frame_end in frames:
+                    frame = State.Frame(depth + relative_depth, actor, frame_begin)
+                    frame.end = frame_end
+                    state._stack.append(frame)
+                state._index = end
+                state.decode_success(self)
+                yield state
+                state.decode_retry(self)
+                del state._stack[frame_index:]
+                state._index = begin
+        state.decode_failure(self)
+
+
 class Exclusion(Alternative):
     """
     Prevents a child element from decoding if it matches an exclusion element or function.
@@ -28,6 +237,9 @@ class Exclusion(Alternative):
         self._exclude_if_func = exclude_if_func
         super(Exclusion, self).__init__((element,), name=element.name, default=element.default)
 
+    def first_words(self, visiting):
+        return first_words(self._element, visiting)
+
     def decode(self, state):
         state.decode_attempt(self)
 
@@ -59,12 +271,109 @@ class Exclusion(Alternative):
         return
 
 
+class PhraseMatcher(object):
+    """
+    Word level Aho-Corasick automaton over a set of phrases.
+
+    A phrase matches when its words occur as consecutive whole words, ignoring case. The automaton is built once, then
+    any number of phrases is searched for in one pass over the words.
+    """
+
+    start = 0
+
+    def __init__(self, phrases):
+        self._goto = [{}]
+        self._fail = [0]
+        self._accepts = [False]
+        for phrase in phrases:
+            state = self.start
+            for word in phrase.lower().split():
+                if word not in self._goto[state]:
+                    self._goto[state][word] = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._accepts.append(False)
+                state = self._goto[state][word]
+            self._accepts[state] = True
+
+        queue = deque(self._goto[self.start].values())
+        while queue:
+            state = queue.popleft()
+            for word, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and word not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(word, self.start)
+                self._accepts[next_state] = self._accepts[next_state] or self._accepts[self._fail[next_state]]
+
+    def step(self, state, word):
+        """Returns the state after reading the word in the given state."""
+        word = word.lower()
+        while state and word not in self._goto[state]:
+            state = self._fail[state]
+        return self._goto[state].get(word, self.start)
+
+    def accepts(self, state):
+        """Returns whether a phrase ends at the last word read to reach the state."""
+        return self._accepts[state]
+
+    def search(self, words):
+        """Returns whether any phrase occurs in the words."""
+        state = self.start
+        if self._accepts[state]:
+            return True
+        for word in words:
+            state = self.step(state, word)
+            if self._accepts[state]:
+                return True
+        return False
+
+
 class PhrasesExclusion(Exclusion):
+    """
+    Prevents a child element from decoding if its words contain any of the phrases.
+
+    If the child is a plain Repetition, the repetitions are decoded here and each repetition's words are fed to the
+    phrase matcher as they are consumed. A decoding is then pruned as soon as the words consumed so far contain an
+    excluded phrase, and no word lists are built. The value is still the list of the repetition values.
+    """
+
     def __init__(self, element, phrases_to_exclude):
         self._phrases = phrases_to_exclude
+        self._matcher = PhraseMatcher(phrases_to_exclude)
+        self._repetition = element if type(element) is Repetition else None
+        super(PhrasesExclusion, self).__init__(element, exclude_if_func=self._matcher.search)
+
+    def decode(self, state):
+        if self._repetition is None:
+            for _ in super(PhrasesExclusion, self).decode(state):
+                yield state
+            return
+        state.decode_attempt(self)
+        if not self._matcher.accepts(self._matcher.start):
+            for _ in self._decode_repetitions(state, 0, self._matcher.start):
+                state.decode_success(self)
+                yield state
+                state.decode_retry(self)
+        state.decode_failure(self)
 
-        def exclude_if(words):
-            text = ' '.join(words)
-            return any(phrase in text for phrase in phrases_to_exclude)
+    def _decode_repetitions(self, state, count, matcher_state):
+        if count + 1 < self._repetition.max:
+            begin = state._index
+            for _ in self._repetition._child.decode(state):
+                next_state = matcher_state
+                for index in range(begin, state._index):
+                    next_state = self._matcher.step(next_state, state._results[index][0])
+                    if self._matcher.accepts(next_state):
+                        break
+                if not self._matcher.accepts(next_state):
+                    for _ in self._decode_repetitions(state, count + 1, next_state):
+                        yield state
+        if count >= self._repetition.min:
+            yield state
 
-        super(PhrasesExclusion, self).__init__(element, exclude_if_func=exclude_if)
+    def value(self, node):
+        if self._repetition is None:
+            return super(PhrasesExclusion, self).value(node)
+        return [child.value() for child in node.children]
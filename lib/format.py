@@ -1,5 +1,6 @@
-from dragonfly import Text, Function, MappingRule, Dictation
+from dragonfly import Function, MappingRule, Dictation
 
+from lib.actions import Text
 from lib.common import lowercase_key_map
 
 
@@ -0,0 +1,236 @@
+"""
+On-disk cache of the binaries that Natlink compiles grammars into.
+
+While installed, NatlinkCompiler.compile_grammar looks up each grammar by a key made of the cache format, the
+dragonfly version, the names of the grammar and its rules, and the sources of the script modules that contribute to
+it: the modules of its rule and element classes, the modules loading it and every loaded lib module. Changing any of
+those sources compiles the grammar again. Grammars whose elements depend on anything besides these sources, e.g. a
+file read at import, must not be loaded while the cache is installed. Neither must a rule whose elements change after
+the first grammar using it is loaded, as the modules of each rule are only collected once.
+"""
+import base64
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import weakref
+from functools import lru_cache
+
+from dragonfly import Repetition
+from dragonfly.engines.backend_natlink.compiler import NatlinkCompiler
+
+from log import logger
+
+CACHE_FORMAT = 1
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_CACHE_DIR = os.path.join(SCRIPTS_DIR, '.grammar_cache')
+
+
+def _distribution_version(name):
+    """Returns the installed version of the distribution, or None if it is not installed."""
+    try:
+        from importlib import metadata
+    except ImportError:  # python 3.7
+        import pkg_resources
+        try:
+            return pkg_resources.get_distribution(name).version
+        except pkg_resources.DistributionNotFound:
+            return None
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return None
+
+
+@lru_cache(maxsize=None)
+def dragonfly_version():
+    version = _distribution_version('dragonfly2')
+    return 'unknown' if version is None else version
+
+
+def _script_path(module_name):
+    path = getattr(sys.modules.get(module_name), '__file__', None)
+    if path is None:
+        return None
+    path = os.path.abspath(path)
+    return path if path.startswith(SCRIPTS_DIR + os.sep) else None
+
+
+def _collect_modules(element, modules, seen):
+    if id(element) in seen:
+        return
+    seen.add(id(element))
+    modules.add(type(element).__module__)
+    for child in (element._child,) if isinstance(element, Repetition) else element.children:
+        _collect_modules(child, modules, seen)
+
+
+_rule_modules: 'weakref.WeakKeyDictionary[object, frozenset]' = weakref.WeakKeyDictionary()
+
+
+def _modules_of_rule(rule):
+    """Returns the modules of the classes of the rule and its elements, collected once per rule."""
+    modules = _rule_modules.get(rule)
+    if modules is None:
+        modules = {type(rule).__module__}
+        if rule.element is not None:
+            _collect_modules(rule.element, modules, set())
+        modules = _rule_modules[rule] = frozenset(modules)
+    return modules
+
+
+def _calling_modules():
+    frame = sys._getframe(1)
+    while frame is not None:
+        yield frame.f_globals.get('__name__')
+        frame = frame.f_back
+
+
+def contributing_sources(grammar):
+    """Returns the sorted paths of the script modules whose sources the compiled grammar depends on."""
+    modules = {name for name in sys.modules if name == 'lib' or name.startswith('lib.')}
+    modules.update(_calling_modules())
+    for rule in grammar.rules:
+        modules.update(_modules_of_rule(rule))
+    return sorted(path for path in map(_script_path, modules) if path is not None)
+
+
+class GrammarCache(object):
+    """
+    Stores the compiled binary and rule names of every grammar Natlink loads, and reuses them when the key matches.
+
+    Usage::
+
+        grammar_cache = GrammarCache().install()
+        ...
+        grammar_cache.uninstall()
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_entries=200):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._source_hashes = {}
+        self._source_digests = {}
+        self._original = None
+        self._wrapper = None
+
+    @property
+    def installed(self):
+        return self._original is not None
+
+    def install(self):
+        assert not self.installed, 'grammar cache is already installed'
+        original = NatlinkCompiler.__dict__['compile_grammar']
+        cache = self
+
+        def compile_grammar(compiler, grammar):
+            if not cache.installed:
+                return original(compiler, grammar)
+            return cache.compile_grammar(grammar, lambda: original(compiler, grammar))
+
+        self._original = original
+        self._wrapper = compile_grammar
+        NatlinkCompiler.compile_grammar = compile_grammar
+        return self
+
+    def uninstall(self):
+        if self.installed:
+            # if compile_grammar was patched again after install, e.g. by the startup profiler, the wrapper is kept
+            # and only passes calls on
+            if NatlinkCompiler.__dict__.get('compile_grammar') is self._wrapper:
+                NatlinkCompiler.compile_grammar = self._original
+            self._original = None
+            self._wrapper = None
+
+    @staticmethod
+    def _stamp(path):
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def _source_hash(self, path, stamp):
+        cached = self._source_hashes.get(path)
+        if cached is None or cached[0] != stamp:
+            with open(path, 'rb') as source:
+                cached = (stamp, hashlib.sha256(source.read()).hexdigest())
+            self._source_hashes[path] = cached
+        return cached[1]
+
+    def _sources_digest(self, paths):
+        """Returns the hex digest of the sources, which is only computed again when one of them changes."""
+        stamps = tuple(self._stamp(path) for path in paths)
+        cached = self._source_digests.get(paths)
+        if cached is None or cached[0] != stamps:
+            sources = [(os.path.relpath(path, SCRIPTS_DIR), self._source_hash(path, stamp))
+                       for path, stamp in zip(paths, stamps)]
+            cached = (stamps, hashlib.sha256(json.dumps(sources).encode()).hexdigest())
+            self._source_digests[paths] = cached
+        return cached[1]
+
+    def key(self, grammar):
+        """Returns the hex digest identifying the compiled form of the grammar."""
+        digest = hashlib.sha256()
+        rules = [(rule.name, rule.exported, rule.imported) for rule in grammar.rules]
+        sources = self._sources_digest(tuple(contributing_sources(grammar)))
+        digest.update(json.dumps([CACHE_FORMAT, dragonfly_version(), grammar.name, rules, sources]).encode())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def load(self, key):
+        """Returns the cached (compiled grammar, rule names) of the key, or None."""
+        try:
+            with open(self._path(key), 'r') as entry_file:
+                entry = json.load(entry_file)
+            return base64.b64decode(entry['binary']), tuple(entry['rule_names'])
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as error:
+            logger.warning('ignoring unreadable grammar cache entry %s: %s', key, error)
+            return None
+
+    def store(self, key, compiled_grammar, rule_names):
+        entry = {'binary': base64.b64encode(compiled_grammar).decode('ascii'), 'rule_names': list(rule_names)}
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            handle, temporary_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(handle, 'w') as entry_file:
+                json.dump(entry, entry_file)
+            os.replace(temporary_path, self._path(key))
+            self.prune()
+        except OSError as error:
+            logger.warning('could not store grammar cache entry %s: %s', key, error)
+
+    def prune(self):
+        """Deletes the least recently written entries beyond max_entries."""
+        entries = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith('.json')]
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort(key=os.path.getmtime)
+        for path in entries[:len(entries) - self.max_entries]:
+            os.remove(path)
+
+    def clear(self):
+        if os.path.isdir(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                if name.endswith('.json'):
+                    os.remove(os.path.join(self.cache_dir, name))
+
+    def compile_grammar(self, grammar, compile_function):
+        """
+        :param compile_function: function compiling the grammar on a miss, returning (compiled grammar, rule names)
+        :return: (compiled grammar, rule names) as returned by NatlinkCompiler.compile_grammar
+        """
+        key = self.key(grammar)
+        cached = self.load(key)
+        if cached is not None:
+            self.hits += 1
+            logger.debug('grammar cache hit for %s', grammar.name)
+            return cached
+        self.misses += 1
+        compiled_grammar, rule_names = compile_function()
+        self.store(key, compiled_grammar, rule_names)
+        return compiled_grammar, rule_names
@@ -0,0 +1,177 @@
+"""
+Reports the static complexity of the grammars of the grammar modules, and fails when a grammar exceeds its budget.
+
+Run from the repository root::
+
+    python -m lib.grammar_profiler [--max-elements N] [--max-binary-size N] [module ...]
+
+For every grammar and its rules this prints the number of distinct elements, the number of distinct words, the
+maximum element nesting, the repetition blow-up factor (elements visited when walking the rule tree, divided by
+distinct elements, which grows with nested Repetitions) and the size of the binary that Natlink sends to Dragon.
+"""
+import argparse
+import importlib
+import sys
+
+from dragonfly import Grammar, Literal, get_engine
+
+from lib.interning import intern_elements
+from lib.rules import binary_size, grammar_rules, precompile_static_actions, referenced_rules
+
+
+def _vim_grammars(module):
+    grammars, _ = module.get_shared_vim_rule_set().make_grammars(prefix='Profile')
+    grammars = list(grammars.values())
+    # prepared like the IDE modules prepare the vim grammars they load
+    intern_elements(*grammars)
+    for grammar in grammars:
+        precompile_static_actions(grammar)
+    return grammars
+
+
+def _rule_grammar(name, rule):
+    grammar = Grammar(name)
+    grammar.add_rule(rule)
+    return grammar
+
+
+PROFILED_MODULES = {
+    'gvim': _vim_grammars,
+    'pycharm': lambda module: module.build_grammars(),
+    'visual_studio': lambda module: module.build_grammars(),
+    'chrome': lambda module: module.EXPORT_GRAMMARS,
+    '_slack': lambda module: module.EXPORT_GRAMMARS,
+    'python_language': lambda module: [_rule_grammar('python language', module.PythonRule())],
+    'cpp_language': lambda module: [_rule_grammar('cpp language', module.CPlusPlusRule())],
+}
+
+DEFAULT_BUDGETS = {
+    'elements': 20000,
+    'words': 5000,
+    'depth': 100,
+    'blowup': 50.0,
+    'binary_size': 500000,
+}
+
+
+class ComplexityProfile(object):
+    """Complexity measures of a rule or of a whole grammar."""
+
+    def __init__(self, name, elements=0, expanded=0, words=None, depth=0, binary_size=0):
+        self.name = name
+        self.elements = elements
+        self.expanded = expanded
+        self.words = set() if words is None else words
+        self.depth = depth
+        self.binary_size = binary_size
+
+    @property
+    def blowup(self):
+        return self.expanded / self.elements if self.elements else 1.0
+
+    def measures(self):
+        return {'elements': self.elements, 'words': len(self.words), 'depth': self.depth, 'blowup': self.blowup,
+                'binary_size': self.binary_size}
+
+    def over_budget(self, budgets):
+        """Returns the names of the measures that exceed their budget."""
+        return [measure for measure, value in self.measures().items()
+                if budgets.get(measure) is not None and value > budgets[measure]]
+
+    def format(self):
+        return '%-40s %8d %8d %6d %8.2f %10d' % (self.name, self.elements, len(self.words), self.depth, self.blowup,
+                                                 self.binary_size)
+
+
+def _walk(element, seen, profile, depth):
+    profile.expanded += 1
+    profile.depth = max(profile.depth, depth)
+    if id(element) in seen:
+        # a shared child is compiled and decoded again at each use, but its own children were already counted
+        profile.expanded += seen[id(element)]
+        return seen[id(element)]
+    seen[id(element)] = 0
+    profile.elements += 1
+    if isinstance(element, Literal):
+        profile.words.update(word.lower() for word in element.words)
+    below = 0
+    for child in element.children:
+        below += 1 + _walk(child, seen, profile, depth + 1)
+    seen[id(element)] = below
+    return below
+
+
+def profile_rule(rule):
+    """Profiles the rule on its own, the binary size is what the rule adds to the rules it references."""
+    profile = ComplexityProfile(rule.name)
+    if rule.element is not None:
+        _walk(rule.element, {}, profile, 1)
+    rules = referenced_rules([rule])
+    profile.binary_size = binary_size(rules) - binary_size(rules[1:])
+    return profile
+
+
+def profile_grammar(grammar, rule_profile_cache=None):
+    """
+    :param rule_profile_cache: dict from rule to its profile, for rules shared between grammars
+    :return: profile of the whole grammar, including the rules it references, and the profiles of those rules
+    """
+    if rule_profile_cache is None:
+        rule_profile_cache = {}
+    rules = grammar_rules(grammar)
+    for rule in rules:
+        if rule not in rule_profile_cache:
+            rule_profile_cache[rule] = profile_rule(rule)
+    rule_profiles = [rule_profile_cache[rule] for rule in rules]
+    profile = ComplexityProfile(grammar.name, binary_size=binary_size(rules))
+    for rule_profile in rule_profiles:
+        profile.elements += rule_profile.elements
+        profile.expanded += rule_profile.expanded
+        profile.words |= rule_profile.words
+        profile.depth = max(profile.depth, rule_profile.depth)
+    return profile, rule_profiles
+
+
+def profile_modules(module_names):
+    """Imports the modules and yields (module name, grammar profile, rule profiles) for each of their grammars."""
+    rule_profile_cache = {}
+    for module_name in module_names:
+        module = importlib.import_module(module_name)
+        for grammar in PROFILED_MODULES[module_name](module):
+            profile, rule_profiles = profile_grammar(grammar, rule_profile_cache)
+            yield module_name, profile, rule_profiles
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('modules', nargs='*', default=list(PROFILED_MODULES),
+                        help='grammar modules to profile, all by default: ' + ', '.join(PROFILED_MODULES))
+    parser.add_argument('--rules', action='store_true', help='also report every rule')
+    for measure, budget in DEFAULT_BUDGETS.items():
+        parser.add_argument('--max-' + measure.replace('_', '-'), dest=measure, type=type(budget), default=budget,
+                            help='budget of each grammar (default: %(default)s)')
+    args = parser.parse_args(argv)
+    unknown_modules = [name for name in args.modules if name not in PROFILED_MODULES]
+    if unknown_modules:
+        parser.error('unknown grammar modules: ' + ', '.join(unknown_modules))
+    budgets = {measure: getattr(args, measure) for measure in DEFAULT_BUDGETS}
+
+    engine = get_engine('text')
+    failures = []
+    with engine.connection():
+        print('%-40s %8s %8s %6s %8s %10s' % ('grammar', 'elements', 'words', 'depth', 'blowup', 'binary'))
+        for module_name, profile, rule_profiles in profile_modules(args.modules):
+            print(profile.format())
+            if args.rules:
+                for rule_profile in rule_profiles:
+                    print('  ' + rule_profile.format())
+            for measure in profile.over_budget(budgets):
+                failures.append('%s: grammar %r exceeds its %s budget: %s > %s'
+                                % (module_name, profile.name, measure, profile.measures()[measure], budgets[measure]))
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
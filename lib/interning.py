@@ -0,0 +1,209 @@
+"""
+Grammar build pass that hoists structurally identical named elements into shared non-exported rules.
+
+A named extra such as Choice('register', register_keys) is compiled again at every place it is used, in every rule
+of the grammar. Interning replaces the uses of an extra by RuleRefs to a single rule, so it is compiled once, whenever
+that makes the compiled grammar smaller. Interned rules are shared by every grammar interned afterwards.
+
+Rules are only rewritten before any grammar using them is loaded: a rule of an earlier interning, or of a loaded
+grammar, is left as it is. Intern the grammars of a module together, before loading any of them.
+"""
+import logging
+from enum import Enum
+
+from dragonfly import Alternative, ElementBase, Optional, Repetition, Rule, RuleRef, Sequence
+from dragonfly.engines.backend_natlink.compiler import NatlinkCompiler, _Compiler
+
+from lib.elements import FirstWordIndexMixin
+from lib.rules import binary_size, referenced_rules
+from log import logger
+
+_STRUCTURAL_DECODES = {Alternative.decode, Sequence.decode, Optional.decode}
+_IGNORED_ATTRIBUTES = {'name', '_default', '_id', '_first_word_index', '_always_tried'}
+
+
+class InterningReport(object):
+    """Result of interning grammars. The sizes are None unless they were measured."""
+
+    def __init__(self, grammar_name, interned, replaced, elements_before=None, elements_after=None, bytes_before=None,
+                 bytes_after=None):
+        self.grammar_name = grammar_name
+        self.interned = interned
+        self.replaced = replaced
+        self.elements_saved = elements_before - elements_after if elements_before is not None else None
+        self.bytes_saved = bytes_before - bytes_after if bytes_before is not None else None
+        self.bytes_before = bytes_before
+        self.bytes_after = bytes_after
+
+    def __str__(self):
+        text = 'interned %d elements of grammar %s into %d rules' % (self.replaced, self.grammar_name,
+                                                                      len(self.interned))
+        if self.bytes_before is None:
+            return text
+        return text + ', saving %d compiled elements and %d of %d bytes' % (self.elements_saved, self.bytes_saved,
+                                                                            self.bytes_before)
+
+
+def _can_replace_children(element):
+    return (isinstance(element, FirstWordIndexMixin) or type(element).decode in _STRUCTURAL_DECODES) and \
+        not isinstance(element, Repetition)
+
+
+def _compiled_elements(element):
+    return 1 + sum(_compiled_elements(child) for child in element.children)
+
+
+def _compiled_entries(element):
+    """Returns the number of entries that Natlink compiles the element into, each as large as a rule reference."""
+    compiler = _Compiler()
+    compiler.start_rule_definition('_')
+    NatlinkCompiler().compile_element(element, compiler)
+    return len(compiler._current_rule_definition)
+
+
+class ElementInterner(object):
+    """
+    Numbers elements so that structurally identical elements get the same number, and keeps one shared rule per
+    interned number. A RuleRef to an interned rule gets the number of the element it replaced.
+
+    Elements are kept alive, so an element must not change after it is numbered, except for the children replaced by
+    the interner itself, which match the same words with the same values.
+    """
+
+    def __init__(self):
+        self._numbers = {}
+        self._element_numbers = {}
+        self._rules = {}
+        self._rule_numbers = {}
+        self._entries = {}
+        self._seen_rules = set()
+
+    def number(self, element):
+        if id(element) not in self._element_numbers:
+            if isinstance(element, RuleRef):
+                key = self._rule_numbers.get(element.rule, ('rule', id(element.rule)))
+            else:
+                key = (type(element), tuple(sorted((name, self._freeze(value)) for name, value in vars(element).items()
+                                                   if name not in _IGNORED_ATTRIBUTES)))
+            number = key if isinstance(key, int) else self._numbers.setdefault(key, len(self._numbers))
+            self._element_numbers[id(element)] = (number, element)
+        return self._element_numbers[id(element)][0]
+
+    def _freeze(self, value):
+        if isinstance(value, ElementBase):
+            return 'element', self.number(value)
+        if isinstance(value, (str, int, float, bool, bytes, Enum)) or value is None:
+            return value
+        if isinstance(value, (list, tuple)):
+            return tuple(self._freeze(item) for item in value)
+        if isinstance(value, dict):
+            return 'dict', tuple(sorted((repr(key), self._freeze(item)) for key, item in value.items()))
+        return 'object', id(value)
+
+    def _count_uses(self, element, uses):
+        for child in element.children:
+            if not isinstance(child, RuleRef):
+                number = self.number(child)
+                uses[number] = uses.get(number, 0) + 1
+            if _can_replace_children(child):
+                self._count_uses(child, uses)
+
+    def _should_intern(self, element, uses, defined):
+        """
+        Whether replacing the uses of the element by rule references makes the compiled grammar smaller: each use
+        shrinks to one entry, and unless the grammar already references the interned rule, its definition adds the
+        entries of the element and a header as large as one entry.
+
+        :param defined: numbers of the interned rules that the grammar references already
+        """
+        if not element.name or isinstance(element, RuleRef):
+            return False
+        number = self.number(element)
+        if number not in self._entries:
+            self._entries[number] = _compiled_entries(element)
+        entries = self._entries[number]
+        return uses[number] * (entries - 1) > (0 if number in defined else entries + 1)
+
+    def _rule(self, element):
+        number = self.number(element)
+        if number not in self._rules:
+            rule = Rule('_Interned_%s_%02d' % (element.name, len(self._rules)), element, exported=False)
+            self._rules[number] = rule
+            self._rule_numbers[rule] = number
+        return self._rules[number]
+
+    def _replace_uses(self, element, uses, defined, interned):
+        replaced = 0
+        children = list(element.children)
+        for index, child in enumerate(children):
+            if self._should_intern(child, uses, defined):
+                rule = self._rule(child)
+                interned.add(rule)
+                children[index] = RuleRef(rule, name=child.name, default=child._default)
+                self.number(children[index])
+                replaced += 1
+            elif _can_replace_children(child):
+                replaced += self._replace_uses(child, uses, defined, interned)
+        if tuple(children) != element.children:
+            if isinstance(element, Optional):
+                element._child, = children
+            else:
+                element._children = tuple(children)
+            if isinstance(element, FirstWordIndexMixin):
+                element._first_word_index = None
+        return replaced
+
+    def _can_rewrite(self, rule, grammars):
+        """Whether no grammar using the rule can be loaded yet, as far as the interner knows."""
+        return rule not in self._seen_rules and \
+            (rule.grammar is None or rule.grammar in grammars or not rule.grammar.loaded)
+
+    def intern(self, *grammars, measure=False):
+        """
+        Hoists the named elements that the rules of the grammars use into shared non-exported rules, where that makes
+        the compiled grammars smaller.
+
+        Call this before loading any of the grammars.
+        :param measure: also measure the compiled size before and after, which compiles the grammars twice
+        :return: InterningReport
+        """
+        rules = referenced_rules([rule for grammar in grammars for rule in grammar.rules])
+        rewritable = [rule for rule in rules if self._can_rewrite(rule, grammars) and
+                      _can_replace_children(rule.element)]
+        if measure:
+            elements_before = sum(_compiled_elements(rule.element) for rule in rules)
+            bytes_before = binary_size(rules)
+
+        uses = {}
+        for rule in rewritable:
+            self._count_uses(rule.element, uses)
+        defined = {self._rule_numbers[rule] for rule in rules if rule in self._rule_numbers}
+        interned = set()
+        replaced = 0
+        for rule in rewritable:
+            replaced += self._replace_uses(rule.element, uses, defined, interned)
+        self._seen_rules.update(rules)
+        self._seen_rules.update(interned)
+
+        name = ', '.join(grammar.name for grammar in grammars)
+        if not measure:
+            return InterningReport(name, interned, replaced)
+        rules = referenced_rules([rule for grammar in grammars for rule in grammar.rules])
+        return InterningReport(name, interned, replaced, elements_before,
+                               sum(_compiled_elements(rule.element) for rule in rules), bytes_before,
+                               binary_size(rules))
+
+
+shared_interner = ElementInterner()
+
+
+def intern_elements(*grammars):
+    """
+    Interns the elements of the grammars with the interner shared by all grammars, see ElementInterner.intern. The
+    compiled sizes are only measured and logged when the debug level is enabled.
+    """
+    measure = logger.isEnabledFor(logging.DEBUG)
+    report = shared_interner.intern(*grammars, measure=measure)
+    if measure:
+        logger.debug(str(report))
+    return report
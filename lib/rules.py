@@ -1,23 +1,29 @@
-from dragonfly import CompoundRule, Repetition, IntegerRef
+from dragonfly import CompoundRule, Repetition, MappingRule, RuleRef
+from dragonfly.engines.backend_natlink.compiler import NatlinkCompiler, _Compiler
 
-from lib.actions import EmptyAction
+from lib.actions import CompiledKeys, RepeatedAction, compile_static_action
+from lib.common import NumberRef
+from lib.elements import Memoized
 
 
 class RepeatActionRule(CompoundRule):
     _repeat_action_rule_count = 0
 
-    def __init__(self, element, name=None, exported=None):
+    def __init__(self, element, name=None, exported=None, optimize=None):
         """
         :param element: element whose value is an ActionBase
         :param name:
+        :param optimize: optional function taking the recognized actions and repeat count and returning an equivalent
+            (actions, count) pair
         """
         if name is None:
             name = self.__class__.__name__ + str(self._repeat_action_rule_count)
             RepeatActionRule._repeat_action_rule_count += 1
         spec = "<sequence> [<n> times]"
-        extras = [Repetition(element, min=1, max=7, name="sequence"),
-                  IntegerRef("n", 1, 100), ]
+        extras = [Repetition(Memoized(element), min=1, max=7, name="sequence"),
+                  NumberRef("n", 1, 100), ]
         self.defaults = {'n': 1}
+        self.optimize = optimize
 
         super(RepeatActionRule, self).__init__(name=name, spec=spec, extras=extras, exported=exported)
 
@@ -25,4 +31,80 @@ class RepeatActionRule(CompoundRule):
         seq = node.get_child_by_name('sequence', shallow=True).value()
         n_node = node.get_child_by_name('n', shallow=True)
         n = n_node.value() if n_node is not None else self.defaults['n']
-        return sum(seq * n, EmptyAction())
+        if self.optimize is not None:
+            seq, n = self.optimize(seq, n)
+        return RepeatedAction(seq, n)
+
+
+def _referenced_rules(element, rules):
+    if isinstance(element, RuleRef):
+        _add_rule_and_references(element.rule, rules)
+    # the children of a Repetition are nested copies of its child, which is enough to walk once
+    for child in (element._child,) if isinstance(element, Repetition) else element.children:
+        _referenced_rules(child, rules)
+
+
+def _add_rule_and_references(rule, rules):
+    if rule in rules:
+        return
+    rules.append(rule)
+    if rule.element is not None:
+        _referenced_rules(rule.element, rules)
+
+
+def grammar_rules(grammar):
+    """Returns the rules of the grammar followed by the rules they reference, each once."""
+    return referenced_rules(grammar.rules)
+
+
+def referenced_rules(rules):
+    """Returns the rules followed by the rules they reference, each once."""
+    all_rules = []
+    for rule in rules:
+        _add_rule_and_references(rule, all_rules)
+    return all_rules
+
+
+def binary_size(rules):
+    """Returns the size of the binary that Natlink would send to Dragon for a grammar of the rules."""
+    if not rules:
+        return 0
+    compiler = _Compiler()
+    natlink_compiler = NatlinkCompiler()
+    for rule in rules:
+        natlink_compiler._compile_rule(rule, compiler)
+    return len(compiler.compile())
+
+
+def bind_shared_rules(grammar):
+    """
+    Binds the non-exported rules used by the grammar to it.
+
+    Loading a grammar activates each of its rules through the grammar the rule was last added to, which fails for a
+    rule shared with a grammar that is not loaded. Call this before loading a grammar that shares rules with grammars
+    that may be unloaded.
+    """
+    for rule in grammar_rules(grammar):
+        if not rule.exported:
+            rule.grammar = grammar
+
+
+def precompile_static_actions(grammar):
+    """
+    Replaces the static actions of the mapping rules used by the grammar with their compiled keyboard events.
+
+    Call this before loading the grammar.
+    :return: number of compiled actions
+    """
+    compiled_count = 0
+    for rule in grammar_rules(grammar):
+        if not isinstance(rule, MappingRule) or rule.element is None:
+            continue
+        for compound in rule.element.children:
+            if isinstance(compound._value, CompiledKeys):
+                continue
+            compiled = compile_static_action(compound._value)
+            if compiled is not None:
+                compound._value = compiled
+                compiled_count += 1
+    return compiled_count
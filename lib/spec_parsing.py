@@ -0,0 +1,61 @@
+from threading import Lock
+
+from dragonfly import Compound
+from dragonfly.parsing.parse import spec_parser
+
+
+class SpecParseCache(object):
+    """
+    Process-wide cache from the specs of Compound elements to their parse trees.
+
+    While installed, every Compound, and so every MappingRule and CompoundRule, parses each distinct spec once. Only
+    the parse is cached: the tree does not depend on the extras, and each Compound still builds its own elements from
+    the tree, so elements are never shared between rules.
+    """
+
+    def __init__(self, parser=spec_parser):
+        self.parser = parser
+        self.hits = 0
+        self.misses = 0
+        self._trees = {}
+        self._lock = Lock()
+        self._original = None
+
+    def __len__(self):
+        return len(self._trees)
+
+    @property
+    def installed(self):
+        return self._original is not None
+
+    def install(self):
+        assert not self.installed, 'spec parse cache is already installed'
+        self._original = Compound.__dict__['_parser']
+        Compound._parser = self
+        return self
+
+    def uninstall(self):
+        if self.installed:
+            Compound._parser = self._original
+            self._original = None
+
+    def parse(self, spec):
+        with self._lock:
+            tree = self._trees.get(spec)
+            if tree is not None:
+                self.hits += 1
+                return tree
+            self.misses += 1
+        tree = self.parser.parse(spec)
+        with self._lock:
+            self._trees[spec] = tree
+        return tree
+
+    def clear(self):
+        with self._lock:
+            self._trees.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+spec_parse_cache = SpecParseCache()
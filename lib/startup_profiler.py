@@ -0,0 +1,267 @@
+"""
+Records how long each grammar module takes to start up.
+
+While installed, the profiler times the import of every script module, the compiling and loading of every grammar,
+and optionally, from python 3.9 on, the peak memory allocated while importing, using tracemalloc. When the import of a
+module finishes, its record is logged and appended as one JSON line to the output file. Build time is the time of the
+import itself, excluding the imports of other script modules and the compiling and loading of grammars.
+
+To profile the modules that Natlink loads, set PROFILE_STARTUP in __init__.py, which Natlink loads first. To profile
+headless with the text engine, run from the repository root::
+
+    python -m lib.startup_profiler [--output FILE] [--no-memory] [module ...]
+
+The text engine does not compile grammars, so run this way, every loaded grammar is also compiled with the
+NatlinkCompiler, as Natlink would when loading it, to measure the compile time.
+"""
+import argparse
+import importlib
+import json
+import os
+import sys
+import time
+import tracemalloc
+from importlib.abc import MetaPathFinder
+from threading import get_ident
+
+from dragonfly import Grammar, get_engine
+from dragonfly.engines.backend_natlink.compiler import NatlinkCompiler
+
+from log import logger
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_OUTPUT = os.path.join(SCRIPTS_DIR, 'startup_profile.jsonl')
+DEFAULT_MODULES = ['gvim', 'python_language', 'cpp_language', 'chrome', '_slack', 'pycharm', 'visual_studio']
+# the peak of a module needs tracemalloc.reset_peak, which python 3.7 and 3.8 do not have
+TRACES_PEAK = hasattr(tracemalloc, 'reset_peak')
+
+
+class ModuleRecord(object):
+    """Startup measures of one module, in seconds and bytes."""
+
+    def __init__(self, name):
+        self.name = name
+        self.import_seconds = 0.0
+        self.nested_import_seconds = 0.0
+        self.compile_seconds = 0.0
+        self.load_seconds = 0.0
+        self.grammars = 0
+        self.peak_bytes = None
+        self._start = None
+        self._start_bytes = 0
+        self._peak = 0
+
+    @property
+    def build_seconds(self):
+        return max(0.0, self.import_seconds - self.nested_import_seconds - self.compile_seconds - self.load_seconds)
+
+    def as_dict(self):
+        return {'module': self.name, 'import_seconds': self.import_seconds, 'build_seconds': self.build_seconds,
+                'compile_seconds': self.compile_seconds, 'load_seconds': self.load_seconds,
+                'grammars': self.grammars, 'peak_bytes': self.peak_bytes}
+
+    def format(self):
+        peak = '-' if self.peak_bytes is None else '%d' % (self.peak_bytes // 1024)
+        return '%-24s %8.3f %8.3f %8.3f %8.3f %4d %10s' % (self.name, self.import_seconds, self.build_seconds,
+                                                         self.compile_seconds, self.load_seconds, self.grammars, peak)
+
+
+HEADER = '%-24s %8s %8s %8s %8s %4s %10s' % ('module', 'import', 'build', 'compile', 'load', 'gram', 'peak KiB')
+
+
+class _TimedLoader(object):
+    """Wraps the loader of a script module to time the execution of the module."""
+
+    def __init__(self, loader, profiler):
+        self._loader = loader
+        self._profiler = profiler
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        self._profiler.begin_module(module.__name__)
+        try:
+            self._loader.exec_module(module)
+        finally:
+            self._profiler.end_module(module.__name__)
+
+
+class _ScriptModuleFinder(MetaPathFinder):
+    def __init__(self, profiler):
+        self._profiler = profiler
+
+    def find_spec(self, name, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        if spec.origin and os.path.abspath(spec.origin).startswith(SCRIPTS_DIR + os.sep) and \
+                hasattr(spec.loader, 'exec_module'):
+            spec.loader = _TimedLoader(spec.loader, self._profiler)
+        return spec
+
+
+class StartupProfiler(object):
+    """
+    Times the import, build, compile and load of script modules and their grammars.
+
+    Usage::
+
+        startup_profiler = StartupProfiler().install()
+        import pycharm
+        startup_profiler.uninstall()
+        logger.info('\\n'.join(startup_profiler.report()))
+    """
+
+    def __init__(self, output=DEFAULT_OUTPUT, trace_memory=True, compile_grammars=False):
+        """
+        :param compile_grammars: also compile every loaded grammar with the NatlinkCompiler, for engines that do not
+        """
+        self.output = output
+        self.trace_memory = trace_memory
+        self.compile_grammars = compile_grammars
+        self.session = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.records = []
+        self._stack = []
+        self._finder = None
+        self._originals = None
+        self._wrappers = None
+        self._started_tracemalloc = False
+        self._thread = None
+
+    @property
+    def installed(self):
+        return self._finder is not None
+
+    def install(self):
+        assert not self.installed, 'startup profiler is already installed'
+        self._thread = get_ident()
+        self._finder = _ScriptModuleFinder(self)
+        sys.meta_path.insert(0, self._finder)
+        self._originals = {'load': Grammar.__dict__['load'],
+                           'compile_grammar': NatlinkCompiler.__dict__['compile_grammar']}
+        self._wrappers = {'load': self._wrap(self._originals['load'], 'load_seconds'),
+                          'compile_grammar': self._wrap(self._originals['compile_grammar'], 'compile_seconds')}
+        Grammar.load = self._wrappers['load']
+        NatlinkCompiler.compile_grammar = self._wrappers['compile_grammar']
+        if self.trace_memory and TRACES_PEAK and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        return self
+
+    def uninstall(self):
+        if self.installed:
+            sys.meta_path.remove(self._finder)
+            self._finder = None
+            # a method patched again after install, e.g. by the grammar cache, keeps the wrapper, which then only
+            # passes calls on
+            for cls, name in ((Grammar, 'load'), (NatlinkCompiler, 'compile_grammar')):
+                if cls.__dict__.get(name) is self._wrappers[name]:
+                    setattr(cls, name, self._originals[name])
+            self._originals = None
+            self._wrappers = None
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+                self._started_tracemalloc = False
+
+    def _wrap(self, original, measure):
+        profiler = self
+
+        def timed(instance, *args, **kwargs):
+            if not profiler.installed or not profiler._stack or get_ident() != profiler._thread:
+                return original(instance, *args, **kwargs)
+            record = profiler._stack[-1]
+            compile_seconds = record.compile_seconds
+            start = time.perf_counter()
+            try:
+                result = original(instance, *args, **kwargs)
+                if measure == 'load_seconds' and profiler.compile_grammars:
+                    NatlinkCompiler().compile_grammar(instance)
+                return result
+            finally:
+                seconds = time.perf_counter() - start
+                if measure == 'load_seconds':
+                    # loading compiles the grammar, which is counted separately
+                    seconds -= record.compile_seconds - compile_seconds
+                    record.grammars += 1
+                setattr(record, measure, getattr(record, measure) + seconds)
+
+        return timed
+
+    def begin_module(self, name):
+        if get_ident() != self._thread:
+            return
+        record = ModuleRecord(name)
+        if TRACES_PEAK and tracemalloc.is_tracing():
+            if self._stack:
+                parent = self._stack[-1]
+                parent._peak = max(parent._peak, tracemalloc.get_traced_memory()[1])
+            record._start_bytes = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        self._stack.append(record)
+        record._start = time.perf_counter()
+
+    def end_module(self, name):
+        if get_ident() != self._thread or not self._stack or self._stack[-1].name != name:
+            return
+        record = self._stack.pop()
+        record.import_seconds = time.perf_counter() - record._start
+        if TRACES_PEAK and tracemalloc.is_tracing():
+            record._peak = max(record._peak, tracemalloc.get_traced_memory()[1])
+            record.peak_bytes = record._peak - record._start_bytes
+        if self._stack:
+            parent = self._stack[-1]
+            parent.nested_import_seconds += record.import_seconds
+            parent._peak = max(parent._peak, record._peak)
+        self.records.append(record)
+        self._emit(record)
+
+    def _emit(self, record):
+        logger.info('startup of %s: import %.3f s, build %.3f s, compile %.3f s, load %.3f s, %d grammars, '
+                    'peak %s bytes', record.name, record.import_seconds, record.build_seconds, record.compile_seconds,
+                    record.load_seconds, record.grammars, record.peak_bytes)
+        if self.output is None:
+            return
+        line = dict(record.as_dict(), session=self.session)
+        try:
+            with open(self.output, 'a') as output:
+                output.write(json.dumps(line) + '\n')
+        except OSError as error:
+            logger.warning('could not write startup profile to %s: %s', self.output, error)
+
+    def report(self):
+        """Returns the lines of a table of the records, slowest import first."""
+        return [HEADER] + [record.format() for record in sorted(self.records, key=lambda r: -r.import_seconds)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES,
+                        help='script modules to import, by default: ' + ', '.join(DEFAULT_MODULES))
+    parser.add_argument('--output', default=None, help='file to append the records to as JSON lines')
+    parser.add_argument('--no-memory', dest='trace_memory', action='store_false',
+                        help='do not trace memory, which slows imports down')
+    args = parser.parse_args(argv)
+
+    engine = get_engine('text')
+    with engine.connection():
+        profiler = StartupProfiler(output=args.output, trace_memory=args.trace_memory, compile_grammars=True).install()
+        try:
+            for module_name in args.modules:
+                importlib.import_module(module_name)
+        finally:
+            profiler.uninstall()
+    print('\n'.join(profiler.report()))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,144 @@
+from collections import Counter
+from time import perf_counter
+
+from dragonfly import GrammarError, Rule
+from dragonfly.grammar.state import State
+
+from log import logger
+
+_TRACED_STEPS = ('decode_attempt', 'decode_retry', 'decode_rollback', 'decode_failure')
+
+
+class DecodeBudgetExceeded(GrammarError):
+    """Raised when decoding a recognition takes more steps than the budget of the installed tracer."""
+
+
+def describe(element):
+    if isinstance(element, Rule):
+        return '<%s>' % element.name
+    return element.name or type(element).__name__
+
+
+def element_path(state):
+    """Returns the elements being decoded, from the rule down to the innermost element."""
+    return ' > '.join(describe(frame.actor) for frame in state._stack)
+
+
+def _innermost_rule(state):
+    for frame in reversed(state._stack):
+        if isinstance(frame.actor, Rule):
+            return frame.actor
+    return None
+
+
+class DecodeTracer(object):
+    """
+    Opt-in instrumentation of the decoding of recognitions.
+
+    While installed, the decode steps of State are counted per element and per innermost enclosing rule, the time of
+    every top level rule decode and of every successful recognition is recorded, and a recognition that takes more
+    than budget decode attempts is aborted with DecodeBudgetExceeded.
+
+    Usage::
+
+        with DecodeTracer(budget=10000) as tracer:
+            engine.mimic('...')
+        logger.info('\\n'.join(tracer.report()))
+    """
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.steps = {step: Counter() for step in _TRACED_STEPS}
+        self.rule_steps = Counter()
+        self.rule_seconds = Counter()
+        self.recognitions = []
+        self._originals = None
+
+    @property
+    def installed(self):
+        return self._originals is not None
+
+    def install(self):
+        assert not self.installed, 'tracer is already installed'
+        self._originals = {name: State.__dict__[name] for name in _TRACED_STEPS + ('build_parse_tree',)}
+        for name in _TRACED_STEPS:
+            setattr(State, name, self._wrap_step(name, self._originals[name]))
+        State.build_parse_tree = self._wrap_build_parse_tree(self._originals['build_parse_tree'])
+        return self
+
+    def uninstall(self):
+        if self.installed:
+            for name, original in self._originals.items():
+                setattr(State, name, original)
+            self._originals = None
+
+    def __enter__(self):
+        return self.install()
+
+    def __exit__(self, *exc_info):
+        self.uninstall()
+
+    def reset(self):
+        for counter in self.steps.values():
+            counter.clear()
+        self.rule_steps.clear()
+        self.rule_seconds.clear()
+        del self.recognitions[:]
+
+    def _wrap_step(self, name, original):
+        counter = self.steps[name]
+        is_attempt = name == 'decode_attempt'
+        is_failure = name == 'decode_failure'
+
+        def traced_step(state, element):
+            if is_attempt:
+                trace = state.__dict__.setdefault('_trace', {'start': perf_counter(), 'attempts': 0})
+                trace['attempts'] += 1
+                if not state._stack:
+                    trace['rule_start'] = perf_counter()
+                if self.budget is not None and trace['attempts'] > self.budget:
+                    path = element_path(state)
+                    logger.warning('decode budget of %d steps exceeded for %r at %s > %s', self.budget,
+                                   ' '.join(state.words()), path, describe(element))
+                    raise DecodeBudgetExceeded('decode budget of %d steps exceeded at %s' % (self.budget, path))
+            rule = element if isinstance(element, Rule) else _innermost_rule(state)
+            result = original(state, element)
+            counter[element] += 1
+            self.rule_steps[rule] += 1
+            if is_failure and not state._stack:
+                self.rule_seconds[element] += perf_counter() - state.__dict__['_trace']['rule_start']
+            return result
+
+        return traced_step
+
+    def _wrap_build_parse_tree(self, original):
+        def traced_build_parse_tree(state):
+            trace = state.__dict__.get('_trace')
+            if trace is not None:
+                now = perf_counter()
+                rule = state._stack[0].actor
+                self.rule_seconds[rule] += now - trace['rule_start']
+                self.recognitions.append((tuple(state.words()), rule, now - trace['start'], trace['attempts']))
+            return original(state)
+
+        return traced_build_parse_tree
+
+    def hot_elements(self, count=10):
+        """Returns the elements with the most retries and rollbacks, with their step counts."""
+        backtracks = self.steps['decode_retry'] + self.steps['decode_rollback']
+        return [(element, backtracks[element], self.steps['decode_attempt'][element])
+                for element, _ in backtracks.most_common(count)]
+
+    def report(self, count=10):
+        """Returns the lines of a summary of the hottest rules and elements and the slowest recognitions."""
+        lines = ['rule steps seconds']
+        for rule, steps in self.rule_steps.most_common(count):
+            if rule is not None:
+                lines.append('%s %d %.6f' % (describe(rule), steps, self.rule_seconds[rule]))
+        lines.append('element backtracks attempts')
+        for element, backtracks, attempts in self.hot_elements(count):
+            lines.append('%s %d %d' % (describe(element), backtracks, attempts))
+        lines.append('recognition seconds attempts')
+        for words, rule, seconds, attempts in sorted(self.recognitions, key=lambda r: -r[2])[:count]:
+            lines.append('%r %s %.6f %d' % (' '.join(words), describe(rule), seconds, attempts))
+        return lines
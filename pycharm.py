@@ -1,7 +1,11 @@
-﻿from dragonfly import MappingRule, Function, Key, Pause, IntegerRef, Grammar, Text, Mimic, AppContext
+﻿from dragonfly import MappingRule, Function, Pause, Grammar, Mimic, AppContext
 
-from gvim import get_commands, get_transitions, make_vim_grammars, VimMode
-from lib.common import execute_select, LetterRef
+from gvim import get_shared_vim_rule_set, VimMode
+from lib.actions import Key, Text
+from lib.common import execute_select, LetterRef, NumberRef
+from lib.dynamic import DeferredGrammars
+from lib.interning import intern_elements
+from lib.rules import precompile_static_actions
 from python_language import PythonRule
 
 
@@ -66,25 +70,37 @@ class PycharmGlobalRule(MappingRule):
         'open file': Key('a-n/10,f'),
     }
     extras = [
-        IntegerRef('n', 1, 10, default=1),
+        NumberRef('n', 1, 10, default=1),
         LetterRef('letter'),
     ]
 
 
-commands = get_commands()
-commands[VimMode.INSERT].append(PythonRule(exported=False))
-transitions = get_transitions()
 context = AppContext(executable="pycharm")
-grammars, grammar_switcher = make_vim_grammars(commands, transitions, context, prefix='Py')
 
-pycharm_grammar = Grammar('pycharm global', context=context)
-pycharm_grammar.add_rule(PycharmGlobalRule())
 
-EXPORT_GRAMMARS = list(grammars.values()) + [pycharm_grammar]
-grammars = None
-for grammar in EXPORT_GRAMMARS:
-    grammar.load()
-grammar_switcher.switch_to_mode(VimMode.NORMAL)
+def build_grammars():
+    rule_set = get_shared_vim_rule_set().with_commands({VimMode.INSERT: [PythonRule(exported=False)]})
+    grammars, grammar_switcher = rule_set.make_grammars(context, prefix='Py')
+    grammar_switcher.switch_to_mode(VimMode.NORMAL)
+
+    pycharm_grammar = Grammar('pycharm global', context=context)
+    pycharm_grammar.add_rule(PycharmGlobalRule())
+
+    grammars = list(grammars.values()) + [pycharm_grammar]
+    intern_elements(*grammars)
+    for grammar in grammars:
+        precompile_static_actions(grammar)
+    return grammars
+
+
+# Build and load the grammars the first time a matching window is in the foreground, see _dynamic_manager.py.
+# Set IDLE_UNLOAD_SECONDS to unload them again when no matching window was in the foreground for that long.
+DEFER_GRAMMARS = True
+IDLE_UNLOAD_SECONDS = None
+DEFERRED_GRAMMARS = DeferredGrammars(context, build_grammars, idle_unload_seconds=IDLE_UNLOAD_SECONDS)
+EXPORT_GRAMMARS = DEFERRED_GRAMMARS.grammars
+if not DEFER_GRAMMARS:
+    DEFERRED_GRAMMARS.load()
 
 
 # class ActiveGrammarsReporter(RecognitionObserver):
@@ -108,6 +124,5 @@ grammar_switcher.switch_to_mode(VimMode.NORMAL)
 def unload():
     global EXPORT_GRAMMARS
     if EXPORT_GRAMMARS is not None:
-        for grammar in EXPORT_GRAMMARS:
-            grammar.unload()
+        DEFERRED_GRAMMARS.unload()
         EXPORT_GRAMMARS = None
@@ -1,7 +1,8 @@
-from dragonfly import MappingRule, Key, Text
+from lib.actions import Key, Text
+from lib.elements import IndexedMappingRule
 
 
-class PythonRule(MappingRule):
+class PythonRule(IndexedMappingRule):
     mapping = {
         # Commands and keywords:
         "and": Text(" and "),
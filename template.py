@@ -1,7 +1,6 @@
-from dragonfly import MappingRule, Function, Key, Mouse, Pause, Repeat, Dictation, IntegerRef, Grammar, Text, \
-    ShortIntegerRef, AppContext
+from dragonfly import MappingRule, Function, Key, Mouse, Pause, Repeat, Dictation, Grammar, Text, AppContext
 
-from lib.common import LetterSequenceRef
+from lib.common import LetterSequenceRef, NumberRef
 
 rules = MappingRule(
     name="template",
@@ -11,7 +10,7 @@ rules = MappingRule(
     extras=[
         LetterSequenceRef('letter_sequence'),
         Dictation("text"),
-        ShortIntegerRef('n', 1, 101, default=1)
+        NumberRef('n', 1, 101, default=1, short=True)
     ],
 )
 context = AppContext(executable="template")
@@ -0,0 +1,108 @@
+import pytest
+from dragonfly import Function, Key, Keyboard, Pause, Repeat, Text
+from dragonfly.actions.action_base_keyboard import BaseKeyboardAction
+
+from lib.actions import BatchedAction, EmptyAction, MarkedAction, RepeatedAction, SpecCache, spec_cache, \
+    compile_static_action, Key as CachedKey, Text as CachedText
+from test.utils import assert_same_typed_keys
+
+
+@pytest.fixture()
+def keyboard_calls(typed_keys, monkeypatch):
+    calls = []
+
+    def send_keyboard_events(_cls, events):
+        calls.append(list(events))
+        typed_keys['buffer'].extend([(key, down) for key, down, pause_time in events])
+
+    monkeypatch.setattr(Keyboard, 'send_keyboard_events', send_keyboard_events)
+    return calls
+
+
+def test_batched_action_types_same_keys(typed_keys):
+    action = Key('a,b') + Text('cd') + MarkedAction(Key('e') * Repeat(count=2), mark=1) + EmptyAction()
+    assert_same_typed_keys(typed_keys, BatchedAction(action), action)
+
+
+def test_batched_action_sends_once(keyboard_calls):
+    action = Key('a') + Text('b') + Key('%(letter)s') * Repeat('n')
+    data = {'letter': 'c', 'n': 2}
+    action.execute(data)
+    expected = [event for call in keyboard_calls for event in call]
+    del keyboard_calls[:]
+
+    BatchedAction(action).execute(data)
+    assert keyboard_calls == [expected]
+
+
+def test_batched_action_folds_pause(keyboard_calls):
+    Key('a/5').execute()
+    key_events = keyboard_calls.pop()
+
+    BatchedAction(Key('a/5') + Pause('10') + Key('b')).execute()
+    assert len(keyboard_calls) == 1
+    assert keyboard_calls[0][len(key_events) - 1][2] == pytest.approx(key_events[-1][2] + 0.1)
+
+
+def test_batched_action_flushes_before_other_actions(keyboard_calls):
+    order = []
+    BatchedAction(Key('a'), Function(lambda: order.append(len(keyboard_calls))), Key('b')).execute()
+    assert order == [1]
+    assert len(keyboard_calls) == 2
+
+
+def test_batched_action_leaves_shared_keyboard_alone(keyboard_calls):
+    keyboard = BaseKeyboardAction._keyboard
+    shared_keyboards = []
+
+    class ProbeKey(Key):
+        def _execute_events(self, events):
+            shared_keyboards.append(BaseKeyboardAction._keyboard)
+            return super(ProbeKey, self)._execute_events(events)
+
+    BatchedAction(Key('a'), ProbeKey('b'), Text('c')).execute()
+    assert shared_keyboards == [keyboard]
+    assert BaseKeyboardAction._keyboard is keyboard
+    assert len(keyboard_calls) == 1
+
+
+def test_repeated_action(typed_keys):
+    action = RepeatedAction([Key('a'), Text('b')], 3)
+    assert action.expanded_length == 6
+    assert_same_typed_keys(typed_keys, action, Key('a,b,a,b,a,b'))
+    assert_same_typed_keys(typed_keys, BatchedAction(action), Key('a,b,a,b,a,b'))
+
+
+def test_spec_cache_skips_parsing_repeated_specs(typed_keys):
+    spec_cache.clear()
+    action = CachedKey('%(letter)s,b') + CachedText('%(n)d')
+    action.execute({'letter': 'a', 'n': 3})
+    assert (spec_cache.hits, spec_cache.misses) == (0, 2)
+    action.execute({'letter': 'a', 'n': 3})
+    assert (spec_cache.hits, spec_cache.misses) == (2, 2)
+    del typed_keys['buffer'][:]
+    assert_same_typed_keys(typed_keys, action.bind({'letter': 'a', 'n': 3}), Key('a,b') + Text('3'))
+
+
+def test_spec_cache_is_bounded():
+    cache = SpecCache(max_size=2)
+    for spec in ['a', 'b', 'a', 'c']:
+        cache.parse(CachedKey('x'), spec, lambda s: [s])
+    assert len(cache) == 2
+    assert cache.parse(CachedKey('x'), 'a', lambda s: [s]) == ('a',)
+    assert cache.misses == 3
+
+
+def test_compile_static_action(typed_keys):
+    action = Key('a,b') + Pause('5') + Text('c') * 2
+    keyboard = BaseKeyboardAction._keyboard
+    compiled = compile_static_action(action)
+    assert compiled.copy_bind({'n': 1}) is compiled
+    assert BaseKeyboardAction._keyboard is keyboard
+    assert_same_typed_keys(typed_keys, compiled, action)
+
+
+def test_compile_static_action_skips_dynamic_actions():
+    assert compile_static_action(Key('%(letter)s')) is None
+    assert compile_static_action(Key('a') + Function(lambda: None)) is None
+    assert compile_static_action(Pause('5') + Key('a')) is None
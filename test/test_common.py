@@ -0,0 +1,72 @@
+from dragonfly import Grammar, IntegerRef, Literal, Modifier, Repetition, Rule, Sequence, ShortIntegerRef
+from dragonfly.engines.backend_natlink.compiler import NatlinkCompiler
+from dragonfly.test import ElementTester, RecognitionFailure
+
+from lib.common import DigitSequence, LetterRef, LetterSequence, LetterSequenceRef, NumberRef
+from lib.elements import spoken_phrases
+
+
+def repetition_letter_sequence(name, max=32):
+    return Modifier(Repetition(LetterRef(), min=1, max=max, name=name), lambda keys: ','.join(keys))
+
+
+def test_spoken_phrases():
+    letter = LetterRef()
+    phrases = {('alpha',), ('big', 'alpha'), ('upper', 'alpha'), ('quote',), ('single', 'quote')}
+    assert spoken_phrases(letter) >= phrases
+    assert spoken_phrases(Literal('a b')) == {('a', 'b')}
+
+
+def test_letter_sequence_matches_repetition(engine):
+    sequence = ElementTester(LetterSequenceRef('letters'), engine)
+    repetition = ElementTester(repetition_letter_sequence('letters'), engine)
+    for words in ('alpha', 'big alpha bravo', 'single quote quote upper zulu', 'one two three', 'Double Quote dot'):
+        assert sequence.recognize(words) == repetition.recognize(words)
+    assert sequence.recognize('big alpha bravo') == 'A,b'
+    assert sequence.recognize('big') is RecognitionFailure
+    assert sequence.recognize('alpha nothing') is RecognitionFailure
+
+
+def test_letter_sequence_backtracks_and_stops_at_max(engine):
+    element = Sequence([LetterSequence('letters', max=4), Literal('alpha bravo')])
+    tester = ElementTester(element, engine)
+    assert tester.recognize('charlie delta alpha bravo') == ['c,d', 'alpha bravo']
+    assert tester.recognize('alpha alpha alpha bravo') == ['a,a', 'alpha bravo']
+    assert ElementTester(LetterSequence('letters', max=4), engine).recognize('alpha alpha alpha alpha') \
+        is RecognitionFailure
+
+
+def test_letter_sequence_compiles(engine):
+    grammar = Grammar('letters')
+    grammar.add_rule(Rule('letters', LetterSequenceRef('letters'), exported=True))
+    compiled, _ = NatlinkCompiler().compile_grammar(grammar)
+    assert len(compiled) > 0
+
+
+def test_number_ref_shares_rule_per_range():
+    assert NumberRef('n', 1, 101).rule is NumberRef('m', 1, 101, default=1).rule
+    assert NumberRef('n', 1, 101).rule is not NumberRef('n', 1, 101, short=True).rule
+    assert NumberRef('n', 1, 101).rule is not NumberRef('n', 1, 50).rule
+
+
+def test_number_ref_matches_integer_ref(engine):
+    for number, integer in ((NumberRef('n', 1, 101), IntegerRef('n', 1, 101)),
+                            (NumberRef('n', 1, 10000, short=True), ShortIntegerRef('n', 1, 10000))):
+        number_tester, integer_tester = ElementTester(number, engine), ElementTester(integer, engine)
+        for words in ('one', 'forty two', 'one hundred', 'one twenty three', 'two thousand five', 'zero'):
+            assert number_tester.recognize(words) == integer_tester.recognize(words)
+
+
+def test_number_ref_digits(engine):
+    tester = ElementTester(NumberRef('n', 1, 10000, short=True, digits=True), engine)
+    assert tester.recognize('one two three') == 123
+    assert tester.recognize('one hundred twenty three') == 123
+    assert tester.recognize('nine nine nine nine') == 9999
+    assert tester.recognize('zero') is RecognitionFailure
+    assert tester.recognize('one zero zero zero zero') is RecognitionFailure
+    assert tester.recognize('zero five') is RecognitionFailure
+    assert ElementTester(DigitSequence('n', 0, 100), engine).recognize('zero') == 0
+    assert ElementTester(Sequence([DigitSequence('n', 0, 100), Literal('five')]), engine).recognize(
+        'zero five') == [0, 'five']
+    assert ElementTester(Sequence([DigitSequence('n', 1, 1000), Literal('two')]), engine).recognize(
+        'four two') == [4, 'two']
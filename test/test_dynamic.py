@@ -0,0 +1,337 @@
+import threading
+import time
+from collections import namedtuple
+
+import pytest
+from dragonfly import AppContext, Context
+
+from lib import dynamic
+from lib.dynamic import DeferredGrammars, DynamicContext, DynamicGrammarStateManager, ForegroundWatcher, \
+    MemoizedContext, memoize_context, states_to_bitmap
+
+FakeWindow = namedtuple('FakeWindow', 'executable title handle')
+
+
+class FakeGrammar(object):
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.loaded = False
+        self.name = 'fake'
+        self.rules = []
+        self.calls = 0
+
+    def load(self):
+        self.loaded = True
+
+    def unload(self):
+        self.loaded = False
+
+    def enable(self):
+        self.enabled = True
+        self.calls += 1
+
+    def disable(self):
+        self.enabled = False
+        self.calls += 1
+
+
+@pytest.fixture()
+def foreground(monkeypatch):
+    window = {'current': FakeWindow('editor', '', 1)}
+    monkeypatch.setattr(dynamic.Window, 'get_foreground', staticmethod(lambda: window['current']))
+    return window
+
+
+@pytest.fixture()
+def grammars():
+    return {'pycharm': [FakeGrammar(True), FakeGrammar(False), FakeGrammar(True)],
+            'chrome': [FakeGrammar(True)]}
+
+
+@pytest.fixture()
+def manager(grammars):
+    context = DynamicContext(fallback=None, focus_context=AppContext(executable='nxplayer'))
+    return DynamicGrammarStateManager(grammars, {}, context)
+
+
+def test_states_to_bitmap():
+    assert states_to_bitmap([True, False, True]) == 0b101
+    assert states_to_bitmap([]) == 0
+
+
+def test_dynamic_context_falls_back_outside_focus_context():
+    context = DynamicContext(fallback=AppContext(executable='pycharm'), focus_context=AppContext(executable='nxplayer'))
+    assert context.matches('nxplayer.exe', '', 1)
+    assert context.matches('pycharm64.exe', '', 1)
+    assert not context.matches('chrome.exe', '', 1)
+
+
+def test_apply_states_only_touches_changed_grammars(manager, grammars):
+    assert manager.apply_states_to_grammars(grammars['pycharm'], 0b011) == 2
+    assert [g.enabled for g in grammars['pycharm']] == [True, True, False]
+    assert [g.calls for g in grammars['pycharm']] == [0, 1, 1]
+    assert manager.apply_states_to_grammars(grammars['pycharm'], 0b011) == 0
+
+
+def test_focus_transitions_restore_states(manager, grammars, foreground):
+    manager.on_begin()
+    assert not manager.is_dynamic_active
+    assert manager.engine_calls == 0
+
+    foreground['current'] = FakeWindow('nxplayer', '', 2)
+    manager.on_begin()
+    assert manager.is_dynamic_active
+    assert not any(g.enabled for gs in grammars.values() for g in gs)
+    assert manager.engine_calls == 3
+
+    manager.on_begin()
+    assert manager.engine_calls == 3
+
+    foreground['current'] = FakeWindow('editor', '', 1)
+    manager.on_begin()
+    assert [g.enabled for g in grammars['pycharm']] == [True, False, True]
+    assert grammars['chrome'][0].enabled
+    assert manager.engine_calls == 6
+
+
+def test_dynamic_enable_disables_other_modules(manager, grammars, foreground):
+    foreground['current'] = FakeWindow('nxplayer', '', 2)
+    manager.on_begin()
+    manager.dynamic_enable('pycharm')
+    assert [g.enabled for g in grammars['pycharm']] == [True, False, True]
+    manager.dynamic_enable('chrome')
+    assert not any(g.enabled for g in grammars['pycharm'])
+    assert grammars['chrome'][0].enabled
+    manager.dynamic_enable('pycharm')
+    assert [g.enabled for g in grammars['pycharm']] == [True, False, True]
+    assert not grammars['chrome'][0].enabled
+
+
+class CountingContext(AppContext):
+    def __init__(self, *args, **kwargs):
+        super(CountingContext, self).__init__(*args, **kwargs)
+        self.calls = 0
+
+    def matches(self, executable, title, handle):
+        self.calls += 1
+        return super(CountingContext, self).matches(executable, title, handle)
+
+
+def test_memoize_context_shares_wrapper_and_results():
+    context = CountingContext(executable='pycharm')
+    memoized = memoize_context(context)
+    assert memoize_context(context) is memoized
+    assert memoize_context(memoized) is memoized
+    assert memoized.matches('pycharm64.exe', 'a', 1)
+    assert memoized.matches('pycharm64.exe', 'a', 1)
+    assert not memoized.matches('chrome.exe', 'a', 2)
+    assert context.calls == 2
+
+
+def test_dynamic_contexts_share_memoized_fallback():
+    fallback = CountingContext(executable='pycharm')
+    focus = CountingContext(executable='nxplayer')
+    contexts = [DynamicContext(fallback=fallback, focus_context=focus) for _ in range(5)]
+    assert all(context.matches('pycharm64.exe', '', 1) for context in contexts)
+    assert (fallback.calls, focus.calls) == (1, 1)
+
+
+def test_memoize_context_skips_contexts_depending_on_more_than_the_window():
+    state = {'active': True}
+
+    class StateContext(Context):
+        def matches(self, executable, title, handle):
+            return state['active']
+
+    func_context = StateContext()
+    app_context = AppContext(executable='pycharm')
+    assert memoize_context(func_context) is func_context
+    assert memoize_context(app_context | func_context) is not memoize_context(app_context)
+    assert isinstance(memoize_context(~app_context), MemoizedContext)
+
+    context = DynamicContext(fallback=app_context & func_context, focus_context=AppContext(executable='nxplayer'))
+    assert context.matches('pycharm64.exe', '', 1)
+    state['active'] = False
+    assert not context.matches('pycharm64.exe', '', 1)
+    assert memoize_context(context) is context
+
+
+def test_memoized_contexts_are_released():
+    context = AppContext(executable='pycharm')
+    memoize_context(context)
+    assert id(context) not in dynamic._memoized_contexts
+
+
+def test_foreground_watcher_backs_off_while_idle():
+    windows = [FakeWindow('editor', '', 1)]
+    seen = []
+    watcher = ForegroundWatcher(lambda *window: seen.append(window), window_provider=lambda: windows[-1],
+                                min_interval=0.1, max_interval=0.3, backoff=2)
+    assert watcher.poll()
+    assert not watcher.poll()
+    assert watcher.interval == pytest.approx(0.2)
+    watcher.poll()
+    assert watcher.interval == pytest.approx(0.3)
+    windows.append(FakeWindow('nxplayer', '', 2))
+    assert watcher.poll()
+    assert watcher.interval == pytest.approx(0.1)
+    assert seen == [('editor', '', 1), ('nxplayer', '', 2)]
+
+
+def test_foreground_watcher_applies_states_before_on_begin(manager, grammars, foreground):
+    watcher = ForegroundWatcher(manager.update, window_provider=lambda: foreground['current'])
+    foreground['current'] = FakeWindow('nxplayer', '', 2)
+    watcher.poll()
+    assert manager.is_dynamic_active
+    calls = manager.engine_calls
+    manager.on_begin()
+    assert manager.engine_calls == calls
+
+
+def test_foreground_watcher_uses_engine_timer(engine):
+    watcher = ForegroundWatcher(lambda *window: None, window_provider=lambda: ('editor', '', 1))
+    watcher.start(engine)
+    timer = watcher._timer
+    assert timer.active
+    watcher.stop()
+    assert not timer.active
+
+
+def test_foreground_watcher_applies_interval_to_next_call(engine):
+    watcher = ForegroundWatcher(lambda *window: None, window_provider=lambda: ('editor', '', 1), min_interval=0.1,
+                                max_interval=10, backoff=20)
+    watcher.start(engine)
+    timer = watcher._timer
+    try:
+        timer.call()
+        assert timer.next_time - time.time() == pytest.approx(0.1, abs=0.05)
+        timer.call()
+        assert timer.interval == 2
+        assert timer.next_time - time.time() == pytest.approx(2, abs=0.05)
+    finally:
+        watcher.stop()
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_deferred(idle_unload_seconds=None):
+    built = []
+
+    def build():
+        built.append([FakeGrammar(True), FakeGrammar(False)])
+        return built[-1]
+
+    clock = FakeClock()
+    return DeferredGrammars(AppContext(executable='pycharm'), build, idle_unload_seconds, clock=clock), built, clock
+
+
+def test_deferred_grammars_load_on_first_matching_window():
+    deferred, built, _ = make_deferred()
+    grammars = deferred.grammars
+    deferred.update('chrome.exe', '', 1)
+    assert not built and not grammars
+    deferred.update('pycharm64.exe', '', 2)
+    deferred.update('pycharm64.exe', '', 3)
+    assert len(built) == 1
+    assert deferred.grammars is grammars and grammars == built[0]
+    assert all(g.loaded for g in grammars)
+    deferred.update('chrome.exe', '', 1)
+    assert all(g.loaded for g in grammars)
+
+
+def test_deferred_grammars_load_on_engine_thread_only():
+    deferred, built, _ = make_deferred()
+    timer_thread = threading.Thread(target=deferred.update, args=('pycharm64.exe', '', 2))
+    timer_thread.start()
+    timer_thread.join()
+    assert not built and not deferred.loaded
+    deferred.update('pycharm64.exe', '', 2)
+    assert len(built) == 1 and deferred.loaded
+
+
+def test_deferred_grammars_unload_when_idle():
+    deferred, built, clock = make_deferred(idle_unload_seconds=60)
+    loads = []
+    deferred.on_load.append(loads.append)
+    deferred.update('pycharm64.exe', '', 2)
+    clock.now = 59
+    deferred.update('chrome.exe', '', 1)
+    assert deferred.loaded
+    clock.now = 60
+    deferred.update('chrome.exe', '', 1)
+    assert not deferred.loaded and not any(g.loaded for g in deferred.grammars)
+    deferred.pinned = True
+    deferred.update('chrome.exe', '', 1)
+    assert deferred.loaded and len(built) == 1 and len(loads) == 2
+
+
+def test_manager_loads_deferred_grammars(foreground):
+    deferred, built, _ = make_deferred()
+    grammars = {'pycharm': deferred.grammars, 'chrome': [FakeGrammar(True)]}
+    context = DynamicContext(fallback=None, focus_context=AppContext(executable='nxplayer'))
+    manager = DynamicGrammarStateManager(grammars, {}, context, deferred_grammars={'pycharm': deferred})
+    foreground['current'] = FakeWindow('pycharm64', '', 2)
+    manager.on_begin()
+    assert not built
+    manager.update(*foreground['current'])
+    assert deferred.loaded
+    assert manager.static_grammar_states['pycharm'] == 0b01
+
+    foreground['current'] = FakeWindow('nxplayer', '', 3)
+    manager.on_begin()
+    assert not any(g.enabled for g in deferred.grammars)
+    manager.dynamic_enable('pycharm')
+    assert deferred.pinned
+    assert [g.enabled for g in deferred.grammars] == [True, False]
+    manager.dynamic_disable('pycharm')
+    assert not deferred.pinned
+
+
+def test_manager_enable_builds_deferred_grammars(foreground):
+    deferred, built, _ = make_deferred()
+    grammars = {'pycharm': deferred.grammars, 'chrome': [FakeGrammar(True)]}
+    context = DynamicContext(fallback=None, focus_context=AppContext(executable='nxplayer'))
+    manager = DynamicGrammarStateManager(grammars, {}, context, deferred_grammars={'pycharm': deferred})
+    foreground['current'] = FakeWindow('nxplayer', '', 3)
+    manager.on_begin()
+    manager.dynamic_enable('pycharm')
+    assert deferred.loaded and len(built) == 1
+    assert [g.enabled for g in deferred.grammars] == [True, False]
+    assert not grammars['chrome'][0].enabled
+
+
+def test_manager_keeps_static_states_of_reloaded_grammars(foreground):
+    deferred, built, clock = make_deferred(idle_unload_seconds=60)
+    grammars = {'pycharm': deferred.grammars, 'chrome': [FakeGrammar(True)]}
+    context = DynamicContext(fallback=None, focus_context=AppContext(executable='nxplayer'))
+    manager = DynamicGrammarStateManager(grammars, {}, context, deferred_grammars={'pycharm': deferred})
+    manager.update('pycharm64', '', 2)
+    manager.update('nxplayer', '', 3)
+    assert not any(g.enabled for g in deferred.grammars)
+    clock.now = 60
+    manager.update('nxplayer', '', 3)
+    assert not deferred.loaded
+
+    manager.update('pycharm64', '', 2)
+    assert deferred.loaded and len(built) == 1
+    assert [g.enabled for g in deferred.grammars] == [True, False]
+
+
+def test_manager_loads_pending_deferred_grammars_on_begin(foreground):
+    deferred, built, _ = make_deferred()
+    grammars = {'pycharm': deferred.grammars}
+    context = DynamicContext(fallback=None, focus_context=AppContext(executable='nxplayer'))
+    manager = DynamicGrammarStateManager(grammars, {}, context, deferred_grammars={'pycharm': deferred})
+    foreground['current'] = FakeWindow('pycharm64', '', 2)
+    timer_thread = threading.Thread(target=manager.update_deferred_grammars, args=foreground['current'])
+    timer_thread.start()
+    timer_thread.join()
+    assert deferred.pending and not built
+    manager.on_begin()
+    assert deferred.loaded and not deferred.pending
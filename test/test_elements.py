@@ -1,7 +1,8 @@
 from dragonfly import *
 from dragonfly.test import ElementTester, RecognitionFailure
 
-from lib.elements import Exclusion, PhrasesExclusion
+from lib.elements import Exclusion, PhrasesExclusion, IndexedAlternative, IndexedChoice, IndexedMappingRule, \
+    Memoized, PhraseMatcher, first_words
 
 
 def test_exclusion(engine):
@@ -49,3 +50,133 @@ def test_phrases_exclusion(engine):
     assert tester.recognize('b a a b') is RecognitionFailure
     assert tester.recognize('b a b a') == [2, 1, 2, 1]
     assert tester.recognize('b b') is RecognitionFailure
+
+
+def test_first_words():
+    assert first_words(Literal('Foo bar')) == ({'foo'}, False)
+    assert first_words(Compound('[please] (go|move) <n>', extras=[IntegerRef('n', 1, 5)])) is not None
+    assert first_words(Sequence([Optional(Literal('a')), Literal('b')])) == ({'a', 'b'}, False)
+    assert first_words(Optional(Literal('a'))) == ({'a'}, True)
+    assert first_words(Dictation('text')) is None
+
+
+def test_indexed_alternative_tries_matching_children(engine):
+    alternative = IndexedAlternative([Literal('foo', value=1), Literal('bar', value=2),
+                                      Sequence([Optional(Literal('big')), Literal('baz')], name='seq'),
+                                      Dictation('text')])
+    tester = ElementTester(alternative, engine)
+    assert tester.recognize('bar') == 2
+    assert tester.recognize('baz') == [None, 'baz']
+    assert tester.recognize('big baz') == ['big', 'baz']
+    assert tester.recognize('hello there').format() == 'hello there'
+    assert alternative.candidate_children('bar') == tuple(alternative.children[i] for i in (1, 3))
+    assert alternative.candidate_children('hello') == (alternative.children[3],)
+
+
+def test_indexed_choice(engine):
+    choice = IndexedChoice('choice', {'a': 1, 'b': 2, 'big a': 3})
+    tester = ElementTester(choice, engine)
+    assert tester.recognize('a') == 1
+    assert tester.recognize('big a') == 3
+    assert tester.recognize('c') is RecognitionFailure
+
+
+def test_indexed_mapping_rule(engine):
+    class Rule(IndexedMappingRule):
+        mapping = {'foo [<n>]': 'foo', 'bar': 'bar'}
+        extras = [IntegerRef('n', 1, 5)]
+
+    tester = ElementTester(RuleRef(Rule()), engine)
+    assert tester.recognize('foo two') == 'foo'
+    assert tester.recognize('bar') == 'bar'
+    assert tester.recognize('baz') is RecognitionFailure
+
+
+class CountingAlternative(Alternative):
+    def __init__(self, children):
+        self.decodes = 0
+        super(CountingAlternative, self).__init__(children)
+
+    def decode(self, state):
+        self.decodes += 1
+        return super(CountingAlternative, self).decode(state)
+
+
+def test_memoized_decodes_child_once_per_position(engine):
+    plain_child = CountingAlternative([Literal('a', value=1), Literal('a a', value=2)])
+    memoized_child = CountingAlternative([Literal('a', value=1), Literal('a a', value=2)])
+    for child in [plain_child, Memoized(memoized_child)]:
+        element = Sequence([Repetition(child, min=1, max=7), Literal('b')])
+        assert ElementTester(element, engine).recognize('a a a a a a c') is RecognitionFailure
+    assert memoized_child.decodes == 7
+    assert plain_child.decodes > 60
+
+
+def test_memoized_replays_decodings(engine):
+    def make_element(child):
+        repetition = Repetition(child, min=1, max=7, name='seq')
+        return Alternative([Sequence([repetition, Literal('x')]), Sequence([repetition, Literal('a y')])])
+
+    plain_child = Alternative([Literal('a', value=1), Literal('a a', value=2)])
+    memoized_child = CountingAlternative([Literal('a', value=1), Literal('a a', value=2)])
+    words = 'a a a a y'
+    expected = ElementTester(make_element(plain_child), engine).recognize(words)
+    assert expected == [[1, 1, 1], 'a y']
+    assert ElementTester(make_element(Memoized(memoized_child)), engine).recognize(words) == expected
+    assert memoized_child.decodes == 5
+
+
+def test_phrase_matcher():
+    matcher = PhraseMatcher(['a b c', 'b c d', 'c', 'x y'])
+    assert matcher.search(['q', 'A', 'b', 'c'])
+    assert matcher.search(['b', 'c'])
+    assert matcher.search(['x', 'x', 'y'])
+    assert not matcher.search(['x', 'b', 'y'])
+    assert not matcher.search(['cc', 'xy'])
+    assert not PhraseMatcher([]).search(['a'])
+
+
+def test_phrases_exclusion_matches_whole_words(engine):
+    choice = Choice('choice', choices={'a': 1, 'ba': 2})
+    exclusion = PhrasesExclusion(element=Repetition(choice, min=1, max=5), phrases_to_exclude=['a a'])
+    tester = ElementTester(exclusion, engine)
+    assert tester.recognize('ba a') == [2, 1]
+    assert tester.recognize('ba a a') is RecognitionFailure
+
+
+def test_phrases_exclusion_over_repetition(engine):
+    choice = Choice('choice', choices={'a': 1, 'b': 2, 'b a': 3})
+    exclusion = PhrasesExclusion(Repetition(choice, min=2, max=5), phrases_to_exclude=['a a', 'b b'])
+
+    tester = ElementTester(exclusion, engine)
+    assert tester.recognize('a a') is RecognitionFailure
+    assert tester.recognize('c') is RecognitionFailure
+    assert tester.recognize('a') is RecognitionFailure
+    assert tester.recognize('a b') == [1, 2]
+    assert tester.recognize('b a b a') == [2, 1, 2, 1]
+    assert tester.recognize('b a a b') is RecognitionFailure
+    assert tester.recognize('b b') is RecognitionFailure
+
+
+class CountingChoice(Choice):
+    def __init__(self, *args, **kwargs):
+        super(CountingChoice, self).__init__(*args, **kwargs)
+        self.decodes = 0
+
+    def decode(self, state):
+        self.decodes += 1
+        return super(CountingChoice, self).decode(state)
+
+
+def test_phrases_exclusion_prunes_early(engine):
+    words = ' '.join(['a'] * 10)
+    full = CountingChoice('choice', choices={'a': 1, 'a a': 2})
+    pruned = CountingChoice('choice', choices={'a': 1, 'a a': 2})
+    phrases = ['a a a']
+
+    exclusion = Exclusion(Repetition(full, min=1, max=11), exclude_if_func=PhraseMatcher(phrases).search)
+    assert ElementTester(exclusion, engine).recognize(words) is RecognitionFailure
+    assert ElementTester(PhrasesExclusion(Repetition(pruned, min=1, max=11), phrases), engine).recognize(words) \
+        is RecognitionFailure
+    assert pruned.decodes < 10
+    assert full.decodes > 50
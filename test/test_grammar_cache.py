@@ -0,0 +1,82 @@
+import importlib
+import sys
+
+from dragonfly import Grammar, Literal, MappingRule, Repetition, Rule, RuleRef
+from dragonfly.engines.backend_natlink.compiler import NatlinkCompiler
+
+import lib.grammar_cache
+from lib.grammar_cache import GrammarCache, contributing_sources
+
+
+def make_grammar():
+    letters = Rule('letters', Repetition(Literal('alpha bravo'), min=1, max=4), exported=False)
+    grammar = Grammar('cached')
+    grammar.add_rule(MappingRule('commands', mapping={'go <letters>': 1, 'stop': 2},
+                                 extras=[RuleRef(letters, name='letters')]))
+    grammar.add_all_dependencies()
+    return grammar
+
+
+def test_grammar_cache_reuses_compiled_grammar(tmp_path):
+    grammar = make_grammar()
+    expected = NatlinkCompiler().compile_grammar(grammar)
+    original = NatlinkCompiler.compile_grammar
+    with_cache = GrammarCache(cache_dir=str(tmp_path)).install()
+    try:
+        assert NatlinkCompiler().compile_grammar(grammar) == expected
+        assert NatlinkCompiler().compile_grammar(grammar) == expected
+        assert (with_cache.hits, with_cache.misses) == (1, 1)
+        assert GrammarCache(cache_dir=str(tmp_path)).load(with_cache.key(grammar)) == expected
+    finally:
+        with_cache.uninstall()
+    assert NatlinkCompiler.compile_grammar is original
+
+
+def test_grammar_cache_ignores_corrupt_entries(tmp_path):
+    grammar = make_grammar()
+    cache = GrammarCache(cache_dir=str(tmp_path))
+    (tmp_path / (cache.key(grammar) + '.json')).write_text('{')
+    assert cache.compile_grammar(grammar, lambda: (b'binary', ('commands',))) == (b'binary', ('commands',))
+    assert cache.load(cache.key(grammar)) == (b'binary', ('commands',))
+
+
+def test_grammar_cache_prunes_old_entries(tmp_path):
+    cache = GrammarCache(cache_dir=str(tmp_path), max_entries=2)
+    for key in ('a', 'b', 'c'):
+        cache.store(key, b'binary', [])
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_grammar_cache_key_follows_sources(tmp_path, monkeypatch):
+    monkeypatch.setattr(lib.grammar_cache, 'SCRIPTS_DIR', str(tmp_path))
+    monkeypatch.syspath_prepend(str(tmp_path))
+    source = tmp_path / 'cached_rules.py'
+    source.write_text("from dragonfly import MappingRule\n\n\nclass CachedRule(MappingRule):\n"
+                      "    mapping = {'go': 1}\n")
+    module = importlib.import_module('cached_rules')
+    try:
+        grammar = Grammar('cached')
+        grammar.add_rule(module.CachedRule())
+        assert str(source) in contributing_sources(grammar)
+        cache = GrammarCache(cache_dir=str(tmp_path / 'cache'))
+        key = cache.key(grammar)
+        assert cache.key(grammar) == key
+        source.write_text(source.read_text() + "    extras = []\n")
+        assert cache.key(grammar) != key
+    finally:
+        del sys.modules['cached_rules']
+
+
+def test_grammar_cache_hashes_sources_once_per_module_set(tmp_path, monkeypatch):
+    cache = GrammarCache(cache_dir=str(tmp_path))
+    first, second = make_grammar(), make_grammar()
+    hashed = []
+    original_source_hash = cache._source_hash
+
+    def source_hash(path, stamp):
+        hashed.append(path)
+        return original_source_hash(path, stamp)
+
+    monkeypatch.setattr(cache, '_source_hash', source_hash)
+    assert cache.key(first) == cache.key(second)
+    assert len(hashed) == len(set(hashed)) and len(cache._source_digests) == 1
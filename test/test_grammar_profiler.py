@@ -0,0 +1,40 @@
+from dragonfly import Grammar, Literal, MappingRule, Repetition, Rule, RuleRef
+
+from lib.grammar_profiler import profile_grammar, profile_modules, profile_rule
+
+
+def make_grammar():
+    letters = Rule('letters', Repetition(Literal('alpha bravo'), min=1, max=4), exported=False)
+    grammar = Grammar('profiled')
+    grammar.add_rule(MappingRule('commands', mapping={'go <letters>': 1, 'stop': 2},
+                                 extras=[RuleRef(letters, name='letters')]))
+    return grammar, letters
+
+
+def test_profile_rule():
+    _, letters = make_grammar()
+    profile = profile_rule(letters)
+    assert profile.words == {'alpha', 'bravo'}
+    assert profile.elements < profile.expanded
+    assert profile.blowup > 1
+    assert profile.depth > 2
+    assert profile.binary_size > 0
+
+
+def test_profile_grammar_includes_referenced_rules():
+    grammar, letters = make_grammar()
+    profile, rule_profiles = profile_grammar(grammar)
+    assert [rule_profile.name for rule_profile in rule_profiles] == ['commands', 'letters']
+    assert profile.words == {'go', 'stop', 'alpha', 'bravo'}
+    assert profile.elements == sum(rule_profile.elements for rule_profile in rule_profiles)
+    assert profile.binary_size > rule_profiles[0].binary_size
+    assert profile.over_budget({'words': 4, 'depth': None}) == []
+    assert profile.over_budget({'words': 3, 'binary_size': 1}) == ['words', 'binary_size']
+
+
+def test_profile_modules(engine):
+    profiles = list(profile_modules(['python_language']))
+    assert len(profiles) == 1
+    module_name, profile, rule_profiles = profiles[0]
+    assert module_name == 'python_language'
+    assert profile.elements > 0 and profile.binary_size > 0
@@ -2,9 +2,11 @@ import pytest
 from dragonfly.test import ElementTester, RecognitionFailure
 
 from gvim import *
-from gvim import _make_mode_rules, _make_transition_then_repeats
-from lib.actions import MarkedAction
+from gvim import _make_mode_rules, _make_repeat_rules, _make_transition_then_repeats
+from lib.actions import CompiledKeys, MarkedAction
+from lib.elements import RuleOrElemAlternative
 from lib.grammar_switcher import GrammarSwitcher
+from lib.rules import precompile_static_actions
 from test.utils import assert_same_typed_keys
 
 
@@ -14,8 +16,9 @@ def mode_rules():
     prefix = ''
     commands = get_commands()
     transitions = get_transitions()
-    transitions_then_repeats = _make_transition_then_repeats(commands, prefix, transitions)
-    return _make_mode_rules(commands, vgs, '', transitions_then_repeats)
+    repeat_rules = _make_repeat_rules(commands, prefix)
+    transitions_then_repeats = _make_transition_then_repeats(commands, prefix, transitions, repeat_rules)
+    return _make_mode_rules(commands, vgs, '', transitions_then_repeats, repeat_rules)
 
 
 @pytest.fixture()
@@ -34,10 +37,21 @@ def normal_mode_rule_tester(mode_rules, rule_test_grammar):
 def test_normal_mode_rule(normal_mode_rule_tester, typed_keys):
     extras = normal_mode_rule_tester.recognize_extras('up up down change word down up')
     actual = extras['repeat_command'] + extras['transition_command']
-    expected = Key('1,k,1,k,1,j,1,c,w,down,up')
+    expected = Key('2,k,1,j,1,c,w,down,up')
     assert_same_typed_keys(typed_keys, actual, expected)
 
 
+def test_normal_mode_rule_folds_repeated_motions(normal_mode_rule_tester, typed_keys):
+    extras = normal_mode_rule_tester.recognize_extras('down down down down five times')
+    assert extras['repeat_command'].expanded_length == 1
+    assert_same_typed_keys(typed_keys, extras['repeat_command'], Text('20') + Key('j'))
+
+
+def test_normal_mode_rule_folds_adjacent_motions_only(normal_mode_rule_tester, typed_keys):
+    extras = normal_mode_rule_tester.recognize_extras('up up two down up two times')
+    assert_same_typed_keys(typed_keys, extras['repeat_command'], Key('2,k,2,j,1,k,2,k,2,j,1,k'))
+
+
 @pytest.fixture()
 def normal_mode_to_insert_mode_tester(engine):
     element = RuleRef(NormalModeToInsertModeCommands())
@@ -266,6 +280,18 @@ def test_repeat_action_rule(engine, typed_keys):
     assert tester.recognize('blah') is RecognitionFailure
 
 
+def test_repeat_action_rule_does_not_expand(engine, typed_keys):
+    class Rule1(MappingRule):
+        mapping = {'foo': Key('a'), 'bar': Key('b')}
+
+    element = RuleRef(RepeatActionRule(RuleRef(Rule1())))
+    tester = ElementTester(element, engine)
+    value = tester.recognize('foo bar foo bar foo bar ninety nine times')
+    assert value.expanded_length == 6 * 99
+    assert len(value.actions) == 6
+    assert_same_typed_keys(typed_keys, value, Key('a,b,a,b,a,b') * Repeat(count=99))
+
+
 def test_find_motion(engine):
     element = FindMotionRef('find')
     tester = ElementTester(element, engine)
@@ -346,6 +372,14 @@ def test_normal_mode_lower_case_text_object_selection_with_count(normal_mode_key
     assert_same_typed_keys(typed_keys, actual, expected)
 
 
+def test_text_object_ref(engine):
+    tester = ElementTester(TextObjectRef('text_object_selection'), engine)
+    assert tester.recognize('inner paren') == 'i,rparen'
+    assert tester.recognize('a big whiskey') == 'a,W'
+    assert tester.recognize('in double quote') == 'i,dquote'
+    assert tester.recognize('paren') is RecognitionFailure
+
+
 def test_normal_mode_lower_case_mandatory_count_motion(normal_mode_keystroke_tester, typed_keys):
     actual = normal_mode_keystroke_tester.recognize('two lower case column')
     expected = Key('2,g,u,bar')
@@ -422,3 +456,58 @@ def test_ex_mode_commands_substitute(ex_mode_commands_tester, typed_keys):
     actual = ex_mode_commands_tester.recognize('substitute')
     expected = Key('s,slash')
     assert_same_typed_keys(typed_keys, actual, expected)
+
+
+class ExtraInsertModeCommands(MappingRule):
+    mapping = {
+        'extra': Key('x,y,z'),
+    }
+
+
+def test_vim_rule_set_with_commands_shares_unchanged_rules():
+    base = VimRuleSet(get_commands(), get_transitions())
+    extra = ExtraInsertModeCommands(exported=False)
+    derived = base.with_commands({VimMode.INSERT: [extra]})
+    assert derived.commands[VimMode.NORMAL] is base.commands[VimMode.NORMAL]
+    assert derived.commands[VimMode.INSERT] == base.commands[VimMode.INSERT] + (extra,)
+    assert extra not in base.commands[VimMode.INSERT]
+    assert (derived.transition_then_repeat_rules(VimMode.INSERT, VimMode.NORMAL) is
+            base.transition_then_repeat_rules(VimMode.INSERT, VimMode.NORMAL))
+    assert (derived.transition_then_repeat_rules(VimMode.NORMAL, VimMode.INSERT) is not
+            base.transition_then_repeat_rules(VimMode.NORMAL, VimMode.INSERT))
+
+
+def test_vim_rule_set_shares_repeat_rule_per_mode():
+    base = VimRuleSet(get_commands(), get_transitions())
+    derived = base.with_commands({VimMode.INSERT: [ExtraInsertModeCommands(exported=False)]})
+    grammars, _ = derived.make_grammars(prefix='Shared')
+
+    normal_repeat = derived.repeat_rule(VimMode.NORMAL)
+    assert normal_repeat is base.repeat_rule(VimMode.NORMAL)
+    assert derived.repeat_rule(VimMode.INSERT) is not base.repeat_rule(VimMode.INSERT)
+    for source in (VimMode.INSERT, VimMode.VISUAL, VimMode.EX):
+        transition_rule, = derived.transition_then_repeat_rules(source, VimMode.NORMAL)
+        assert transition_rule._extras['repeat_command'].rule is normal_repeat
+    assert grammars[VimMode.NORMAL].rules[0]._extras['repeat_command'].rule is normal_repeat
+
+
+def test_vim_rule_set_make_grammars(rule_test_grammar, typed_keys):
+    extra = ExtraInsertModeCommands(exported=False)
+    rule_set = get_shared_vim_rule_set().with_commands({VimMode.INSERT: [extra]})
+    grammars, switcher = rule_set.make_grammars(prefix='Test')
+    assert grammars[VimMode.NORMAL].name == 'TestNormalMode'
+    assert switcher.modes[VimMode.INSERT] is grammars[VimMode.INSERT]
+    insert_rule = grammars[VimMode.INSERT].rules[0]
+    grammars[VimMode.INSERT].remove_rule(insert_rule)
+    rule_test_grammar.add_rule(insert_rule)
+    extras = rule_test_grammar.recognize_extras('extra')
+    assert_same_typed_keys(typed_keys, extras['repeat_command'], Key('x,y,z'))
+
+
+def test_precompile_static_actions(rule_test_grammar, typed_keys):
+    rule_test_grammar.add_rule(NormalModeCommands())
+    assert precompile_static_actions(rule_test_grammar) > 0
+    assert precompile_static_actions(rule_test_grammar) == 0
+    assert isinstance(rule_test_grammar.recognize_node('slap').value(), CompiledKeys)
+    assert_same_typed_keys(typed_keys, rule_test_grammar.recognize_node('slap').value(), Key('enter'))
+    assert_same_typed_keys(typed_keys, rule_test_grammar.recognize_node('three down').value(), Key('3,j'))
@@ -0,0 +1,99 @@
+from dragonfly import Choice, Dictation, Grammar, MappingRule, RuleRef
+from dragonfly.test import RuleTestGrammar
+
+from gvim import NormalModeCommands, register_keys
+from lib.common import LetterRef
+from lib.interning import ElementInterner
+from lib.rules import grammar_rules
+from test.utils import assert_same_typed_keys
+
+
+class FirstRule(MappingRule):
+    mapping = {'first <letter> [register <register>]': 1, 'first say <text>': 2}
+    extras = [LetterRef('letter'), Choice('register', register_keys, default='dquote'), Dictation('text')]
+
+
+class SecondRule(MappingRule):
+    mapping = {'second <letter>': 3, 'second <other_letter>': 4}
+    extras = [LetterRef('letter'), LetterRef('other_letter')]
+
+
+def test_interner_hoists_identical_named_elements():
+    grammar = Grammar('interned')
+    grammar.add_rule(FirstRule())
+    grammar.add_rule(SecondRule())
+    report = ElementInterner().intern(grammar, measure=True)
+    rules = grammar_rules(grammar)
+    interned = [rule for rule in rules if rule.name.startswith('_Interned_')]
+    assert [rule.name for rule in interned] == ['_Interned_letter_00']
+    assert report.interned == set(interned)
+    assert report.replaced == 3
+    assert report.elements_saved > 0 and report.bytes_saved > 0
+
+
+def test_interner_reuses_rules_across_grammars():
+    interner = ElementInterner()
+    first, second = Grammar('first'), Grammar('second')
+    first.add_rule(SecondRule())
+    second.add_rule(SecondRule())
+    interner.intern(first)
+    report = interner.intern(second)
+    assert {rule.name for rule in report.interned} == {'_Interned_letter_00'}
+
+
+def test_interner_keeps_single_uses():
+    interner = ElementInterner()
+    first, second = Grammar('first'), Grammar('second')
+    first.add_rule(SecondRule())
+    second.add_rule(FirstRule())
+    interner.intern(first)
+    report = interner.intern(second, measure=True)
+    assert report.replaced == 0 and report.bytes_saved == 0
+
+
+class RegisterRule(MappingRule):
+    exported = False
+    mapping = {'copy <register>': 1, 'paste <other_register>': 2}
+    extras = [Choice('register', register_keys), Choice('other_register', register_keys)]
+
+
+def make_register_grammars(engine, shared):
+    grammars = [Grammar(name, engine=engine) for name in ('first', 'second')]
+    for grammar in grammars:
+        grammar.add_rule(MappingRule(grammar.name, {grammar.name + ' <shared>': 1}, [RuleRef(shared, name='shared')]))
+    return grammars
+
+
+def test_interner_interns_grammars_together(engine):
+    shared = RegisterRule()
+    report = ElementInterner().intern(*make_register_grammars(engine, shared))
+    assert report.replaced == 2 and report.bytes_saved is None
+    assert report.grammar_name == 'first, second'
+
+
+def test_interner_leaves_rules_of_loaded_grammars_alone(engine):
+    shared = RegisterRule()
+    first, second = make_register_grammars(engine, shared)
+    children = shared.element.children
+    first.load()
+    try:
+        assert ElementInterner().intern(second).replaced == 0
+    finally:
+        first.unload()
+    assert shared.element.children == children
+
+
+def test_interned_rule_decodes_the_same(engine, typed_keys):
+    plain, interned = RuleTestGrammar(engine=engine), RuleTestGrammar(engine=engine)
+    plain.add_rule(NormalModeCommands())
+    interned.add_rule(NormalModeCommands())
+    assert ElementInterner().intern(interned).replaced > 0
+    utterances = ('Dell inner paren', 'two yank a word register bravo', 'find big alpha', 'surround inner word with '
+                  'paren', 'three down')
+    # the grammars share the number rules, which stay bound to the grammar that added them last, so each grammar
+    # recognizes all its utterances in turn
+    expected = [plain.recognize_node(words).value() for words in utterances]
+    actual = [interned.recognize_node(words).value() for words in utterances]
+    for actual_action, expected_action in zip(actual, expected):
+        del typed_keys['buffer'][:]
+        assert_same_typed_keys(typed_keys, actual_action, expected_action)
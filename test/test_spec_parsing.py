@@ -0,0 +1,20 @@
+from dragonfly import Compound, Dictation, MappingRule
+
+from lib.spec_parsing import SpecParseCache
+
+
+def test_spec_parse_cache_shares_parses_but_not_elements(engine, rule_test_grammar):
+    original = Compound._parser
+    cache = SpecParseCache().install()
+    try:
+        rules = [MappingRule('rule%d' % i, mapping={'[please] say <text>': i, 'stop': 'stop'},
+                             extras=[Dictation('text')]) for i in range(2)]
+        assert (cache.hits, cache.misses) == (2, 2)
+        assert len(cache) == 2
+        first, second = (rule.element.children[0] for rule in rules)
+        assert first.children[0] is not second.children[0]
+    finally:
+        cache.uninstall()
+    assert Compound._parser is original
+    rule_test_grammar.add_rule(rules[1])
+    assert rule_test_grammar.recognize_node('say hello').value() == 1
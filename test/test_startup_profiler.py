@@ -0,0 +1,85 @@
+import importlib
+import json
+import sys
+
+from dragonfly import Grammar, MappingRule
+from dragonfly.engines.backend_natlink.compiler import NatlinkCompiler
+
+import lib.startup_profiler
+from lib.grammar_cache import GrammarCache
+from lib.startup_profiler import StartupProfiler
+
+SOURCE = '''
+from dragonfly import Grammar, MappingRule
+
+import profiled_helper
+
+grammar = Grammar('profiled startup')
+grammar.add_rule(MappingRule(mapping={'go': 1}))
+grammar.load()
+'''
+
+
+def test_startup_profiler_records_module_imports(engine, tmp_path, monkeypatch):
+    monkeypatch.setattr(lib.startup_profiler, 'SCRIPTS_DIR', str(tmp_path))
+    monkeypatch.syspath_prepend(str(tmp_path))
+    (tmp_path / 'profiled_module.py').write_text(SOURCE)
+    (tmp_path / 'profiled_helper.py').write_text('HELPER = list(range(1000))\n')
+    output = tmp_path / 'startup.jsonl'
+    original_load = Grammar.load
+    profiler = StartupProfiler(output=str(output), compile_grammars=True).install()
+    try:
+        module = importlib.import_module('profiled_module')
+    finally:
+        profiler.uninstall()
+        sys.modules.pop('profiled_helper', None)
+        sys.modules.pop('profiled_module', None)
+    module.grammar.unload()
+    assert Grammar.load is original_load
+
+    helper, profiled = profiler.records
+    assert (helper.name, profiled.name) == ('profiled_helper', 'profiled_module')
+    assert profiled.grammars == 1 and helper.grammars == 0
+    assert profiled.compile_seconds > 0 and helper.compile_seconds == 0
+    assert profiled.import_seconds >= helper.import_seconds + profiled.load_seconds
+    assert profiled.nested_import_seconds == helper.import_seconds
+    if lib.startup_profiler.TRACES_PEAK:
+        assert helper.peak_bytes > 0
+    else:
+        assert helper.peak_bytes is None
+    lines = [json.loads(line) for line in output.read_text().splitlines()]
+    assert [line['module'] for line in lines] == ['profiled_helper', 'profiled_module']
+    assert lines[1]['grammars'] == 1 and lines[1]['session'] == profiler.session
+    assert len(profiler.report()) == 3
+
+
+def test_startup_profiler_reports_no_peak_without_reset_peak(tmp_path, monkeypatch):
+    monkeypatch.setattr(lib.startup_profiler, 'SCRIPTS_DIR', str(tmp_path))
+    monkeypatch.setattr(lib.startup_profiler, 'TRACES_PEAK', False)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    (tmp_path / 'profiled_helper.py').write_text('HELPER = list(range(1000))\n')
+    profiler = StartupProfiler(output=None).install()
+    try:
+        importlib.import_module('profiled_helper')
+    finally:
+        profiler.uninstall()
+        sys.modules.pop('profiled_helper', None)
+    assert [record.peak_bytes for record in profiler.records] == [None]
+
+
+def test_startup_profiler_uninstalls_under_later_patches(tmp_path, monkeypatch):
+    original = NatlinkCompiler.__dict__['compile_grammar']
+    # restored at teardown, as the wrapper that was patched over is left in place
+    monkeypatch.setattr(NatlinkCompiler, 'compile_grammar', original)
+    profiler = StartupProfiler(output=None).install()
+    grammar_cache = GrammarCache(cache_dir=str(tmp_path)).install()
+    cache_wrapper = NatlinkCompiler.__dict__['compile_grammar']
+    profiler.uninstall()
+    assert NatlinkCompiler.__dict__['compile_grammar'] is cache_wrapper
+    grammar_cache.uninstall()
+    assert NatlinkCompiler.__dict__['compile_grammar'] is not cache_wrapper
+
+    grammar = Grammar('patched')
+    grammar.add_rule(MappingRule(mapping={'go': 1}))
+    assert NatlinkCompiler().compile_grammar(grammar) == original(NatlinkCompiler(), grammar)
+    assert (grammar_cache.hits, grammar_cache.misses) == (0, 0) and profiler.records == []
@@ -0,0 +1,46 @@
+import pytest
+from dragonfly import Choice, Repetition
+from dragonfly.grammar.state import State
+from dragonfly.test import ElementTester, RecognitionFailure
+
+from lib.elements import Exclusion, PhraseMatcher
+from lib.tracing import DecodeBudgetExceeded, DecodeTracer
+
+
+def make_exclusion(phrases):
+    choice = Choice('letter', choices={'a': 1, 'a a': 2, 'a b': 3})
+    return Exclusion(Repetition(choice, min=1, max=11), exclude_if_func=PhraseMatcher(phrases).search), choice
+
+
+def test_tracer_counts_steps_and_recognitions(engine):
+    exclusion, choice = make_exclusion(['b b'])
+    tester = ElementTester(exclusion, engine)
+    with DecodeTracer() as tracer:
+        assert tester.recognize('a b') == [3]
+    assert tracer.steps['decode_attempt'][choice] > 2
+    assert sum(tracer.steps['decode_retry'].values()) > 0
+    assert tracer.hot_elements(count=1)[0][1] > 0
+    assert len(tracer.recognitions) == 1
+    words, rule, seconds, attempts = tracer.recognitions[0]
+    assert words == ('a', 'b') and seconds >= 0 and attempts > 0
+    assert tracer.rule_steps[rule] > 0
+    assert len(tracer.report()) > 3
+
+
+def test_tracer_uninstalls(engine):
+    original = State.decode_attempt
+    tracer = DecodeTracer().install()
+    assert State.decode_attempt is not original
+    tracer.uninstall()
+    assert State.decode_attempt is original
+    ElementTester(make_exclusion(['a a a'])[0], engine).recognize('a')
+    assert not tracer.steps['decode_attempt']
+
+
+def test_tracer_budget_aborts_runaway_decode(engine):
+    tester = ElementTester(make_exclusion(['a a a'])[0], engine)
+    with DecodeTracer(budget=200):
+        with pytest.raises(DecodeBudgetExceeded):
+            tester.recognize(' '.join(['a'] * 10))
+    with DecodeTracer(budget=200):
+        assert tester.recognize('a a') == [1, 1]
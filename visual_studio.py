@@ -1,8 +1,12 @@
-﻿from dragonfly import MappingRule, Function, Key, Pause, IntegerRef, Grammar, Text, AppContext
+﻿from dragonfly import MappingRule, Function, Pause, Grammar, AppContext
 
 from cpp_language import CPlusPlusRule
-from gvim import VimMode, get_commands, get_transitions, make_vim_grammars
-from lib.common import LetterRef, execute_select
+from gvim import VimMode, get_shared_vim_rule_set
+from lib.actions import Key, Text
+from lib.common import LetterRef, NumberRef, execute_select
+from lib.dynamic import DeferredGrammars
+from lib.interning import intern_elements
+from lib.rules import precompile_static_actions
 
 
 def toggle_vim():
@@ -43,30 +47,41 @@ class VisualStudioGlobalRule(MappingRule):
 
     }
     extras = [
-        IntegerRef('n', 1, 10, default=1),
+        NumberRef('n', 1, 10, default=1),
         LetterRef('letter'),
     ]
 
 
-commands = get_commands()
-commands[VimMode.INSERT].append(CPlusPlusRule(exported=False))
-transitions = get_transitions()
 context = AppContext(executable="devenv")
-grammars, grammar_switcher = make_vim_grammars(commands, transitions, context, prefix='VS')
 
-visual_studio_grammar = Grammar('VStudio global', context=context)
-visual_studio_grammar.add_rule(VisualStudioGlobalRule())
 
-EXPORT_GRAMMARS = list(grammars.values()) + [visual_studio_grammar]
-grammars = None
-for grammar in EXPORT_GRAMMARS:
-    grammar.load()
-grammar_switcher.switch_to_mode(VimMode.NORMAL)
+def build_grammars():
+    rule_set = get_shared_vim_rule_set().with_commands({VimMode.INSERT: [CPlusPlusRule(exported=False)]})
+    grammars, grammar_switcher = rule_set.make_grammars(context, prefix='VS')
+    grammar_switcher.switch_to_mode(VimMode.NORMAL)
+
+    visual_studio_grammar = Grammar('VStudio global', context=context)
+    visual_studio_grammar.add_rule(VisualStudioGlobalRule())
+
+    grammars = list(grammars.values()) + [visual_studio_grammar]
+    intern_elements(*grammars)
+    for grammar in grammars:
+        precompile_static_actions(grammar)
+    return grammars
+
+
+# Build and load the grammars the first time a matching window is in the foreground, see _dynamic_manager.py.
+# Set IDLE_UNLOAD_SECONDS to unload them again when no matching window was in the foreground for that long.
+DEFER_GRAMMARS = True
+IDLE_UNLOAD_SECONDS = None
+DEFERRED_GRAMMARS = DeferredGrammars(context, build_grammars, idle_unload_seconds=IDLE_UNLOAD_SECONDS)
+EXPORT_GRAMMARS = DEFERRED_GRAMMARS.grammars
+if not DEFER_GRAMMARS:
+    DEFERRED_GRAMMARS.load()
 
 
 def unload():
     global EXPORT_GRAMMARS
     if EXPORT_GRAMMARS is not None:
-        for grammar in EXPORT_GRAMMARS:
-            grammar.unload()
+        DEFERRED_GRAMMARS.unload()
         EXPORT_GRAMMARS = None